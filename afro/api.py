@@ -1,12 +1,86 @@
 
-import re
+import os
+import tempfile
 
-from quart import request, abort
+import asyncio
+import logging
+from functools import partial
+from urllib.parse import unquote
+
+import aiofiles
+from quart import request, abort, send_file, make_response
 from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+from afro.archive import write_export, CHUNK_SIZE
+from afro.cache import ResponseCache, DEFAULT_SIZE, DEFAULT_TTL
+from afro.clusters import (update_clusters, update_cluster_grades,
+                           clusters_query, grade_spread, MAX_ZOOM)
+from afro.db import get_db, allocate_ids
+from afro.derivatives import (Derivatives, WIDTHS, FORMATS,
+                              DEFAULT_CONCURRENCY)
+from afro.encoding import register_encoding
+from afro.grades import grade_rank, rank_label
+from afro.geometry import (pack_line, unpack_points, unpack_floats,
+                           parse_coordinates, simplify)
+from afro.metrics import register_metrics
+from afro.model import (area, sector, block, problem, photo, line,
+                        area_rtree, sector_rtree, block_rtree)
+from afro.query import (compile_query, id_filter, text_filter, grade_filter,
+                        child_filter)
+from afro.search import (SEARCH, DEFAULT_LIMIT, MAX_LIMIT, match_expression,
+                         search_result)
+from afro.spatial import parse_bbox, nearest
+from afro.statements import (AREA_EXISTS, AREA_GRADES, SECTOR_EXISTS,
+    SECTOR_GRADES, BLOCK_GET, BLOCK_EXISTS,
+    BLOCK_PROBLEMS, BLOCK_PROBLEM_IDS, BLOCK_PHOTOS, PROBLEM_GET,
+    PROBLEM_EXISTS, PROBLEM_PHOTOS, PROBLEM_INSERT, PHOTO_EXISTS, PHOTO_LINES,
+    PHOTO_PROBLEM_INSERT, PHOTO_BLOCK_INSERT, LINE_GET, LINE_INSERT)
+from afro.sync import sync_changes
+from afro.tree import area_tree
+
+log = logging.getLogger(__name__)
+
+BLOCK_ARGS = dict(sector=int, lat=float, lon=float)
+BLOCK_OPTIONAL_ARGS = dict(name=str, description=str)
+PROBLEM_ARGS = dict(block=int)
+PROBLEM_OPTIONAL_ARGS = dict(name=str, description=str, grade=str)
+
+PHOTO_CACHE_TIMEOUT = 365 * 24 * 3600
+MAX_PHOTO_SIZE = 32 * 1024 * 1024
+MAX_BATCH_SIZE = 100
+# routes that don't respond with JSON, refused by /batch
+NOT_JSON_ENDPOINTS = {'photo_raw_get', 'area_export'}
+# ?lod= levels, 1 is about a pixel full screen, 3 is for thumbnails
+LOD_TOLERANCES = (0.0, 0.001, 0.003, 0.01)
+PHOTO_ADD_RETRIES = 5
+
+BLOCK_FILTERS = dict(
+    sector=id_filter(block.c.sector),
+    grade=child_filter(problem.c.block, block.c.id,
+                       grade_filter(problem.c.grade_rank))
+)
+
+SECTOR_FILTERS = dict(area=id_filter(sector.c.area))
+
+def sector_blocks(value):
+    return problem.c.block.in_(select([block.c.id]).where(
+        block.c.sector == int(value)))
 
-from afro.db import get_db
-from afro.model import (block, problem, photo, photo_problem, photo_block,
-                        line, point)
+def area_blocks(value):
+    return problem.c.block.in_(select([block.c.id]).where(
+        block.c.sector.in_(select([sector.c.id]).where(
+        sector.c.area == int(value)))))
+
+PROBLEM_FILTERS = dict(
+    block=id_filter(problem.c.block),
+    sector=sector_blocks,
+    area=area_blocks,
+    name=text_filter(problem.c.name),
+    description=text_filter(problem.c.description),
+    grade=grade_filter(problem.c.grade_rank)
+)
 
 class State:
     pass
@@ -14,116 +88,507 @@ class State:
 class VerifyError(Exception):
     pass
 
-def get_all_points(db, line_id):
-    r = list(db.execute(select([point.c.index, point.c.x, point.c.y]).where(
-             point.c.line_id == line_id)))
-    res = [None] * len(r)
-    for index, x, y in r:
-        res[index] = (x, y)
+def parse_tolerance(args):
+    """ Simplification tolerance asked for with ?tolerance= (in the 0-1
+    photo coordinates) or ?lod= (an index into LOD_TOLERANCES), None for the
+    full geometry. Raises ValueError
+    """
+    if 'tolerance' in args and 'lod' in args:
+        raise ValueError("pass either tolerance or lod, not both")
+    try:
+        if 'tolerance' in args:
+            tolerance = float(args['tolerance'])
+            if not tolerance >= 0:
+                raise ValueError
+            return tolerance
+        if 'lod' in args:
+            return LOD_TOLERANCES[int(args['lod'])]
+    except (ValueError, IndexError):
+        raise ValueError("tolerance must be a non negative number, lod "
+                         "between 0 and %d" % (len(LOD_TOLERANCES) - 1))
+    return None
+
+def line_points(points, importance, tolerance=None):
+    if importance is not None and tolerance:
+        importance = unpack_floats(importance)
+    else:
+        importance = None
+    return simplify(unpack_points(points), importance, tolerance)
+
+async def get_photo_lines(db, photo_filenames, tolerance=None):
+    """ Fetch the lines with their points for all the given photos in one
+    query, simplified to tolerance if not None. Returns a dict of filename
+    -> list of lines, photos that don't exist are missing from the result
+    """
+    res = {}
+    for filename, line_id, problem_id, points, importance in (
+            await db.execute_prepared(PHOTO_LINES,
+                                      filenames=list(photo_filenames))):
+        lines = res.setdefault(filename, [])
+        if line_id is not None:
+            lines.append({
+                'id': line_id,
+                'problem': problem_id,
+                'points': line_points(points, importance, tolerance)
+            })
     return res
 
 def point_list_verifier(v):
-    items = v.split(",")
+    """ Points as a comma separated string or an array of numbers, either
+    flat or as [x, y] pairs
+    """
+    if isinstance(v, str):
+        items = v.split(",")
+    else:
+        items = list(v)
+        if items and isinstance(items[0], (list, tuple)):
+            if any(not isinstance(p, (list, tuple)) or len(p) != 2
+                   for p in items):
+                raise VerifyError("points must be [x, y] pairs")
+            items = [x for p in items for x in p]
+        for item in items:
+            # float(True) works, but a bool is no coordinate
+            if isinstance(item, bool):
+                raise VerifyError("Not a float: %s" % item)
     if len(items) % 2 != 0:
         raise VerifyError("wrong number of numbers in points, must be divisable by 2")
     if len(items) < 2:
         raise VerifyError("you need at least two points to make a line, %d supplied" % len(items))
-    r = []
-    for i, item in enumerate(items):
+    try:
+        return parse_coordinates(items)
+    except ValueError:
+        pass
+    # find the offending item for the error message
+    for item in items:
         try:
             cur = float(item)
-        except ValueError:
+        except (TypeError, ValueError):
             raise VerifyError("Not a float: %s" % item)
         if not 0.0 <= cur <= 1.0:
             raise VerifyError("%s not in range (0, 1)" % cur)
-        if i % 2 == 0:
-            next_item = item
-        else:
-            r.append((next_item, item))
-    return r
+    raise VerifyError("invalid points")
 
-def wrap(required_args=None, optional_args=None):
-    def check_parameters(form):
-        res_params = {}     
-        if required_args is not None:
-            for k, v in required_args.items():
-                if k not in form:
-                    raise VerifyError("parameter %s not passed" % k)
-                val = form.pop(k)
-                try:
-                    res_params[k] = v(val)
-                except (TypeError, ValueError):
-                    raise VerifyError("parameter %s, value %s, expected type %s" %
-                        (k, val, v.__name__))
+LINE_ARGS = dict(problem=int, point_list=point_list_verifier,
+                 photo_filename=str)
+
+# what JSON values the plain argument types accept, bools never count
+JSON_TYPES = {int: int, float: (int, float), str: str}
+
+def convert(tp, value):
+    """ Form values are strings, converted the same way whatever they came
+    from. Other JSON values have to be of the right type already, so 1.9
+    is not an int and true is not a float
+    """
+    if tp in JSON_TYPES and not isinstance(value, str):
+        if isinstance(value, bool) or not isinstance(value, JSON_TYPES[tp]):
+            raise TypeError("%r is not %s" % (value, tp.__name__))
+    return tp(value)
+
+def compile_checker(required_args=None, optional_args=None):
+    """ Turn the argument specs of a route into a function checking a form
+    or a JSON object, returning the converted parameters. The form is left
+    untouched
+    """
+    required = list((required_args or {}).items())
+
+    def check(form):
+        res_params = {}
+        for k, v in required:
+            if k not in form:
+                raise VerifyError("parameter %s not passed" % k)
+            val = form[k]
+            try:
+                res_params[k] = convert(v, val)
+            except (TypeError, ValueError):
+                raise VerifyError("parameter %s, value %s, expected type %s" %
+                    (k, val, v.__name__))
+        if len(form) == len(res_params):
+            return res_params
+        extra = [k for k in form if k not in res_params]
         if optional_args is None:
-            if form:
-                raise VerifyError("Extra parameters passed: %s" % form)
-        else:
-            for k, v in form.items():
-                if k not in optional_args:
-                    raise VerifyError("unexpected parameter %s passed" % k)
-                try:
-                    res_params[k] = optional_args[k](v)
-                except (TypeError, ValueError):
-                    raise VerifyError("optional parameter %s, value %s, expected type %s" %
-                        (k, v, optional_args[k].__name__))
+            raise VerifyError("Extra parameters passed: %s" %
+                              {k: form[k] for k in extra})
+        for k in extra:
+            if k not in optional_args:
+                raise VerifyError("unexpected parameter %s passed" % k)
+            v = form[k]
+            try:
+                res_params[k] = convert(optional_args[k], v)
+            except (TypeError, ValueError):
+                raise VerifyError("optional parameter %s, value %s, expected type %s" %
+                    (k, v, optional_args[k].__name__))
         return res_params
+    return check
+
+check_block = compile_checker(BLOCK_ARGS, BLOCK_OPTIONAL_ARGS)
+check_problem = compile_checker(PROBLEM_ARGS, PROBLEM_OPTIONAL_ARGS)
+check_line = compile_checker(LINE_ARGS)
+
+async def request_parameters():
+    """ Form data, or the JSON object passed as the body
+    """
+    if request.is_json:
+        data = await request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise VerifyError("JSON body must be an object")
+        return data
+    return await request.form
 
+def wrap(required_args=None, optional_args=None):
     def inner_function(orig_func):
+        check = compile_checker(required_args, optional_args)
+
         async def func(*args, **kwds):
             try:
-                form = (await request.form).copy()
-                params = check_parameters(form)
-                r = orig_func(params, *args, **kwds)
-                r = (await r).copy()
-                if 'status' in r:
+                params = check(await request_parameters())
+                r = await orig_func(params, *args, **kwds)
+                if isinstance(r, tuple) or 'status' in r:
                     return r
-                r['status'] = 'OK'
-                return r
+                return dict(r, status='OK')
             except VerifyError as e:
                 return {'status': 'Verification error: %s' % e.args[0]}, 505
         func.__name__ = orig_func.__name__
         return func
     return inner_function
 
+def check_existing(con, column, ids, what):
+    ids = set(ids)
+    if not ids:
+        return
+    found = {x[0] for x in con.execute(select([column]).where(
+             column.in_(ids)))}
+    missing = ids - found
+    if missing:
+        raise VerifyError("unknown %s %s" % (what,
+            ', '.join(sorted(str(x) for x in missing))))
+
+def pop_ref(item, key):
+    """ item[key] removed, a ref has to be a string or an integer """
+    ref = item.pop(key, None)
+    if ref is not None and (isinstance(ref, bool) or
+                            not isinstance(ref, (str, int))):
+        raise VerifyError("%s must be a string or an integer, not %s" % (
+            key, ref))
+    return ref
+
+def resolve_ref(item, key, refs):
+    """ Replace item[key + '_ref'], a temporary ID assigned by the client
+    earlier in the same batch, with the real ID
+    """
+    ref = pop_ref(item, key + '_ref')
+    if ref is None:
+        return
+    if key in item:
+        raise VerifyError("both %s and %s_ref passed" % (key, key))
+    if ref not in refs:
+        raise VerifyError("unknown %s_ref %s" % (key, ref))
+    item[key] = refs[ref]
+
+def check_items(items, what):
+    if not isinstance(items, list):
+        raise VerifyError("%s must be a list" % what)
+    res = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise VerifyError("%s %d is not an object" % (what, i))
+        res.append(dict(item))
+    return res
+
+def insert_bulk(con, blocks, problems, lines, touched):
+    """ Insert whole batches of blocks, problems and lines, meant to be run
+    within a single transaction. Problems can refer to blocks from the same
+    batch with block_ref, lines to problems with problem_ref, refs being
+    whatever was passed as 'ref' of the parent. Keys of the cached entities
+    that changed are added to touched.
+    """
+    res = {'blocks': [], 'problems': [], 'lines': []}
+    block_refs = {}
+    problem_refs = {}
+    if blocks:
+        ids = allocate_ids(con, block, len(blocks))
+        rows = []
+        for id, item in zip(ids, blocks):
+            ref = pop_ref(item, 'ref')
+            if ref is not None:
+                block_refs[ref] = id
+            row = dict.fromkeys(BLOCK_OPTIONAL_ARGS)
+            row.update(check_block(item))
+            row['id'] = id
+            rows.append(row)
+        con.execute(block.insert(), rows)
+        update_clusters(con, [(row['lat'], row['lon']) for row in rows], 1)
+        res['blocks'] = ids
+    if problems:
+        ids = allocate_ids(con, problem, len(problems))
+        rows = []
+        for id, item in zip(ids, problems):
+            ref = pop_ref(item, 'ref')
+            if ref is not None:
+                problem_refs[ref] = id
+            resolve_ref(item, 'block', block_refs)
+            row = dict.fromkeys(PROBLEM_OPTIONAL_ARGS)
+            row.update(check_problem(item))
+            row['id'] = id
+            row['grade_rank'] = grade_rank(row['grade'])
+            rows.append(row)
+        new_ids = set(block_refs.values())
+        check_existing(con, block.c.id, [row['block'] for row in rows
+            if row['block'] not in new_ids], 'block id')
+        con.execute(problem.insert(), rows)
+        update_cluster_grades(con, [(row['block'], row['grade_rank'])
+                                    for row in rows], 1)
+        touched.update(('block', row['block']) for row in rows)
+        res['problems'] = ids
+    if lines:
+        ids = allocate_ids(con, line, len(lines))
+        rows = []
+        for id, item in zip(ids, lines):
+            resolve_ref(item, 'problem', problem_refs)
+            params = check_line(item)
+            points, importance = pack_line(params['point_list'])
+            rows.append({
+                'id': id,
+                'problem': params['problem'],
+                'photo': params['photo_filename'],
+                'points': points,
+                'importance': importance
+            })
+        new_ids = set(problem_refs.values())
+        check_existing(con, problem.c.id, [row['problem'] for row in rows
+            if row['problem'] not in new_ids], 'problem id')
+        check_existing(con, photo.c.filename, [row['photo'] for row in rows],
+                       'photo filename')
+        con.execute(line.insert(), rows)
+        touched.update(('photo', row['photo']) for row in rows)
+        res['lines'] = ids
+    return res
+
+def claim_photo(con, tmp_path, photo_dir):
+    """ Pick the next free photo filename, move the uploaded file there and
+    record it. Meant to be run in a transaction, so the photo only becomes
+    visible once the file is in place
+    """
+    n = con.execute(select([func.count(photo.c.filename)])).scalar()
+    while True:
+        photo_file = "photo%d.jpg" % (n,)
+        q = con.execute(select([photo.c.filename]).where(
+            photo.c.filename == photo_file)).first()
+        if q is None:
+            break
+        n += 1
+    con.execute(photo.insert().values({'filename': photo_file}))
+    os.replace(tmp_path, os.path.join(photo_dir, photo_file))
+    return photo_file
+
+def location_query(table, rtree, query, filters, after=None, limit=None):
+    """ Compile a list query (see afro.query) against one of the tables with
+    a location (area, sector or block). Besides the keys in filters, bbox:
+    and near: terms are supported. Rows are ordered by id, starting after
+    the given id. Returns the statement and the near: term, if any, raises
+    ValueError for an unsupported query
+    """
+    columns = [table.c.id, table.c.name, table.c.description,
+               table.c.lat, table.c.lon]
+    filters = dict(filters, name=text_filter(table.c.name),
+                   description=text_filter(table.c.description))
+    q, near = compile_query(query, table, rtree, columns, filters)
+    if near is not None and (after is not None or limit is not None):
+        raise ValueError("near queries are limited and ordered by distance")
+    return paginate(q, table, after, limit), near
+
+def paginate(q, table, after, limit):
+    """ Order q by id, starting after the given id """
+    if after is not None:
+        q = q.where(table.c.id > after)
+    q = q.order_by(table.c.id)
+    if limit is not None:
+        q = q.limit(limit)
+    return q
+
+def location_dict(row):
+    id, name, description, lat, lon = row
+    return {
+        'id': id,
+        'name': name,
+        'description': description,
+        'lat': lat,
+        'lon': lon
+        }
+
+def problem_query(query, after=None, limit=None):
+    """ Compile a problem list query, see PROBLEM_FILTERS for the keys.
+    Returns the statement and None, problems have no location
+    """
+    columns = [problem.c.id, problem.c.block, problem.c.name,
+               problem.c.description, problem.c.grade]
+    q, near = compile_query(query, problem, None, columns, PROBLEM_FILTERS)
+    return paginate(q, problem, after, limit), near
+
+def problem_dict(row):
+    id, block_id, name, description, grade = row
+    return {
+        'id': id,
+        'block': block_id,
+        'name': name,
+        'description': description,
+        'grade': grade
+        }
+
+def grade_histogram(rows):
+    """ Histogram out of (grade_rank, count) rows ordered by rank """
+    grades = []
+    unranked = 0
+    for rank, count in rows:
+        if rank is None:
+            unranked += count
+        else:
+            grades.append({'rank': rank, 'grade': rank_label(rank),
+                           'count': count})
+    return {'status': 'OK', 'grades': grades, 'unranked': unranked}
+
+def rank_near(r, near):
+    lat, lon, radius, limit = near
+    r = nearest([(x, x['lat'], x['lon']) for x in r], lat, lon, radius, limit)
+    for d, x in r:
+        x['distance'] = d
+    return [x for d, x in r]
+
+def insert_block(con, parameters):
+    r = con.execute(block.insert().values(**parameters))
+    update_clusters(con, [(parameters['lat'], parameters['lon'])], 1)
+    return r.inserted_primary_key[0]
+
+def block_ranks(con, block_id):
+    return [x[0] for x in con.execute(select([problem.c.grade_rank]).where(
+        (problem.c.block == block_id) & problem.c.grade_rank.isnot(None)))]
+
+def update_block(con, block_id, parameters):
+    q = con.execute(select([block.c.lat, block.c.lon]).where(
+        block.c.id == block_id)).first()
+    if q is None:
+        return False
+    con.execute(
+        block.update().where(block.c.id == block_id).values(**parameters))
+    lat = parameters.get('lat', q[0])
+    lon = parameters.get('lon', q[1])
+    if (lat, lon) != tuple(q):
+        ranks = [block_ranks(con, block_id)]
+        update_clusters(con, [tuple(q)], -1, ranks)
+        update_clusters(con, [(lat, lon)], 1, ranks)
+    return True
+
+def delete_block(con, block_id):
+    q = con.execute(select([block.c.lat, block.c.lon]).where(
+        block.c.id == block_id)).first()
+    if q is None:
+        return False
+    update_clusters(con, [tuple(q)], -1, [block_ranks(con, block_id)])
+    con.execute(block.delete().where(block.c.id == block_id))
+    return True
+
+def insert_problem(con, parameters, compiled_cache):
+    rank = grade_rank(parameters.get('grade'))
+    r = con.execution_options(compiled_cache=compiled_cache).execute(
+        PROBLEM_INSERT, dict(parameters, grade_rank=rank))
+    update_cluster_grades(con, [(parameters['block'], rank)], 1)
+    return r.inserted_primary_key[0]
+
 def register_routes(app, state):
     db = get_db(app, state)
+    derivatives = state.derivatives = Derivatives(
+        workers=app.config.get('DERIVATIVE_WORKERS'),
+        concurrency=app.config.get('DERIVATIVE_CONCURRENCY',
+                                   DEFAULT_CONCURRENCY))
+
+    def derivative_dir():
+        return app.config.get('DERIVATIVE_DIR') or os.path.join(
+            str(app.config['tmpdir']), 'derivatives')
+
+    register_metrics(app, state)
+    register_encoding(app)
+
+    # Quart refuses bodies over MAX_CONTENT_LENGTH (16MB by default) before
+    # the routes see them, let photos up to MAX_PHOTO_SIZE through
+    max_length = app.config.get('MAX_CONTENT_LENGTH')
+    if max_length is not None:
+        app.config['MAX_CONTENT_LENGTH'] = max(max_length,
+            app.config.get('MAX_PHOTO_SIZE', MAX_PHOTO_SIZE))
+
+    @app.errorhandler(RequestEntityTooLarge)
+    async def too_large(e):
+        return {'status': 'request too big, maximum size is %d bytes' %
+                request.max_content_length}, 413
+
+    cache = state.cache = ResponseCache(
+        size=app.config.get('CACHE_SIZE', DEFAULT_SIZE),
+        ttl=app.config.get('CACHE_TTL', DEFAULT_TTL))
+
+    @app.after_serving
+    async def close_derivatives():
+        derivatives.close()
+
+    def cached(kind):
+        """ Cache successful responses of a GET route taking the entity ID,
+        keyed by (kind, id) and the query string. Responses carry the
+        entity version as ETag, a matching If-None-Match gets a 304.
+        Versions are per process, so with CACHE off (several workers) routes
+        are left as they are
+        """
+        def inner_function(orig_func):
+            if not app.config.get('CACHE', True):
+                return orig_func
+            async def func(**kwds):
+                (id,) = kwds.values()
+                key = (kind, id)
+                version = cache.version(key)
+                etag = cache.etag(key)
+                # weak comparison, compressed responses carry a weak ETag
+                if request.if_none_match.contains_weak(etag):
+                    r = await make_response('', 304)
+                    r.set_etag(etag)
+                    return r
+                variant = request.query_string
+                entry = cache.get(key, variant)
+                if entry is None:
+                    r = await orig_func(**kwds)
+                    if isinstance(r, tuple):
+                        return r
+                    # keep the serialized body, hits don't encode again
+                    r = await make_response(r)
+                    entry = (await r.get_data(), r.mimetype)
+                    cache.put(key, variant, version, entry)
+                body, mimetype = entry
+                r = app.response_class(body, mimetype=mimetype)
+                r.set_etag(etag)
+                return r
+            func.__name__ = orig_func.__name__
+            return func
+        return inner_function
 
     @app.route('/block/add', methods=['POST'])
-    @wrap(required_args=dict(
-        sector=int,
-        lat=float,
-        lon=float
-    ), optional_args=dict(
-        name=str,
-        description=str
-    ))
+    @wrap(required_args=BLOCK_ARGS, optional_args=BLOCK_OPTIONAL_ARGS)
     async def block_add(parameters):
-        r = db.execute(block.insert().values(**parameters))
-        return {'id': r.inserted_primary_key[0]}
+        return {'id': await db.transaction(insert_block, parameters)}
 
     @app.route('/block/<int:block_id>')
+    @cached('block')
     async def block_get(block_id):
-        q = list(db.execute(
-            select([block.c.sector, block.c.name,
-                block.c.lat, block.c.lon, block.c.description]).where(
-                                       block.c.id == block_id)))
+        q = list(await db.execute_prepared(BLOCK_GET, id=block_id))
         if len(q) == 0:
             return {'status': 'no block id %s found' % block_id}, 505
         assert len(q) == 1
         q = list(q[0])
         if request.args.get('details', 0):
-            prob_q = list(db.execute(
-                select([problem.c.id, problem.c.name, problem.c.grade]).where(
-                    problem.c.block == block_id)))
+            prob_q = list(await db.execute_prepared(BLOCK_PROBLEMS,
+                                                    block=block_id))
             problems = [{
                 'id': x[0],
                 'name': x[1],
                 'grade': x[2]
             } for x in prob_q]
         else:
-            prob_q = list(db.execute(
-                select([problem.c.id]).where(problem.c.block == block_id)))
+            prob_q = list(await db.execute_prepared(BLOCK_PROBLEM_IDS,
+                                                    block=block_id))
             problems = [x[0] for x in prob_q]
         return {"status": 'OK', 'sector': q[0], 'name': q[1],
                 'lat': q[2], 'lon': q[3], 'problems': problems,
@@ -134,75 +599,277 @@ def register_routes(app, state):
         name=str, description=str, lat=float, lon=float
         ))
     async def block_update(parameters, block_id):
-        q = list(db.execute(
-            select([block.c.sector, block.c.name,
-                block.c.lat, block.c.lon, block.c.description]).where(
-                                       block.c.id == block_id)))
-        if len(q) == 0:
+        if not await db.transaction(update_block, block_id, parameters):
             return {'status': 'no block id %s found' % block_id}, 505
-        assert len(q) == 1
-
-        db.execute(
-            block.update().where(block.c.id == block_id).values(**parameters))
+        cache.invalidate(('block', block_id))
         return {'status': "OK"}
 
     @app.route('/block/<int:block_id>/photos')
+    @cached('block_photos')
     async def block_get_photos(block_id):
-        q = list(db.execute(select([block.c.id]).where(
-            block.c.id == block_id)))
+        q = list(await db.execute_prepared(BLOCK_EXISTS, id=block_id))
         if len(q) == 0:
             return {'status': 'no block id %d found' % block_id}, 505
-        q = list(db.execute(select([photo_block.c.photo]).where(
-                 photo_block.c.block == q[0][0])))
+        q = list(await db.execute_prepared(BLOCK_PHOTOS, block=q[0][0]))
         return {'status': 'OK', 'photos': [x[0] for x in q]}
 
-    @app.route('/block/list')
-    async def block_list():
+    def optional_int_arg(name):
+        if name not in request.args:
+            return None
+        return int(request.args[name])
+
+    async def query_list(make_query, make_dict, key):
+        """ Respond to a list query, either with a single JSON document or,
+        with stream=1, with newline delimited JSON, one row per line.
+        make_query is location_query or problem_query with the table bound,
+        make_dict turns a row into JSON
+        """
         if 'q' not in request.args:
             return {'status': 'Query not passed, please pass q parameter'}, 505
-        m = re.match(r'^sector:(\d+)$', request.args['q'])
-        if not m:
+        try:
+            after = optional_int_arg('after')
+            limit = optional_int_arg('limit')
+            if limit is not None and limit <= 0:
+                raise ValueError("limit has to be positive")
+            q, near = make_query(request.args['q'], after=after, limit=limit)
+        except ValueError:
             return {'status': 'Unsupported query - %s' % request.args['q']}, 505
-        sector_id = int(m.group(1))
-        l = list(db.execute(select([block.c.id, block.c.name, block.c.description,
-            block.c.lat, block.c.lon]).where(block.c.sector == sector_id)))
-        r = []
-        for id, name, description, lat, lon in l:
-            r.append({
-                'id': id,
-                'name': name,
-                'description': description,
-                'lat': lat,
-                'lon': lon
-                })
-        return {'status': 'OK', 'blocks': r}
+        if request.args.get('stream', 0):
+            if near is not None:
+                return {'status': "near queries can't be streamed"}, 505
+            query = request.args['q']
+            def chunk_query(after, limit):
+                return make_query(query, after=after, limit=limit)[0]
+            async def generate():
+                # keyset paging, the pool isn't held while the client reads
+                async for row in db.stream(chunk_query, after, limit):
+                    yield app.json.dumps(make_dict(row)) + '\n'
+            return generate(), 200, {'Content-Type': 'application/x-ndjson'}
+        r = [make_dict(row) for row in await db.execute(q)]
+        if near is not None:
+            r = rank_near(r, near)
+        next_after = None
+        if limit is not None and len(r) == limit:
+            next_after = r[-1]['id']
+        return {'status': 'OK', key: r, 'next': next_after}
+
+    @app.route('/block/list')
+    async def block_list():
+        return await query_list(partial(location_query, block, block_rtree,
+                                        filters=BLOCK_FILTERS),
+                                location_dict, 'blocks')
+
+    @app.route('/sector/list')
+    async def sector_list():
+        return await query_list(partial(location_query, sector, sector_rtree,
+                                        filters=SECTOR_FILTERS),
+                                location_dict, 'sectors')
+
+    @app.route('/area/list')
+    async def area_list():
+        return await query_list(partial(location_query, area, area_rtree,
+                                        filters={}),
+                                location_dict, 'areas')
+
+    @app.route('/problem/list')
+    async def problem_list():
+        return await query_list(problem_query, problem_dict, 'problems')
+
+    @app.route('/sector/<int:sector_id>/grades')
+    async def sector_grades(sector_id):
+        q = list(await db.execute_prepared(SECTOR_EXISTS, id=sector_id))
+        if len(q) == 0:
+            return {'status': 'no sector id %d found' % sector_id}, 505
+        return grade_histogram(await db.execute_prepared(SECTOR_GRADES,
+                                                         sector=sector_id))
+
+    @app.route('/area/<int:area_id>/grades')
+    async def area_grades(area_id):
+        q = list(await db.execute_prepared(AREA_EXISTS, id=area_id))
+        if len(q) == 0:
+            return {'status': 'no area id %d found' % area_id}, 505
+        return grade_histogram(await db.execute_prepared(AREA_GRADES,
+                                                         area=area_id))
 
     @app.route('/block/delete', methods=['POST'])
     @wrap(required_args=dict(id=int))
     async def block_delete(parameters):
         block_id = parameters['id']
-        q = list(db.execute(select([block.c.id]).where(
-            block.c.id == block_id)))
-        if len(q) == 0:
+        if not await db.transaction(delete_block, block_id):
             return {'status': 'no block id %d found' % block_id}, 505
-        db.execute(block.delete().where(block.c.id == block_id))
+        cache.invalidate(('block', block_id))
+        cache.invalidate(('block_photos', block_id))
         return {'status': 'OK'}
 
+    @app.route('/block/clusters')
+    async def block_clusters():
+        try:
+            bbox = parse_bbox(request.args['bbox'])
+            zoom = int(request.args['zoom'])
+        except (KeyError, ValueError):
+            return {'status': 'Please pass bbox=minlat,minlon,maxlat,maxlon '
+                    'and zoom parameters'}, 505
+        if not 0 <= zoom <= MAX_ZOOM:
+            return {'status': 'zoom must be between 0 and %d' % MAX_ZOOM}, 505
+        q = await db.execute(clusters_query(*bbox, zoom))
+        return {'status': 'OK', 'clusters': [{
+            'count': count,
+            'lat': sum_lat / count,
+            'lon': sum_lon / count,
+            'grades': grade_spread(*grades)
+            } for count, sum_lat, sum_lon, *grades in q]}
+
+    @app.route('/bulk/add', methods=['POST'])
+    async def bulk_add():
+        data = await request.get_json(force=True, silent=True)
+        try:
+            if not isinstance(data, dict):
+                raise VerifyError("expected a JSON object")
+            blocks = check_items(data.pop('blocks', []), 'blocks')
+            problems = check_items(data.pop('problems', []), 'problems')
+            lines = check_items(data.pop('lines', []), 'lines')
+            if data:
+                raise VerifyError("Extra parameters passed: %s" % data)
+            touched = set()
+            r = await db.transaction(insert_bulk, blocks, problems, lines,
+                                     touched)
+        except VerifyError as e:
+            return {'status': 'Verification error: %s' % e.args[0]}, 505
+        except IntegrityError:
+            return {'status': 'conflicting concurrent write, please retry'}, 505
+        for key in touched:
+            cache.invalidate(key)
+        r['status'] = 'OK'
+        return r
+
+    async def batch_request(path):
+        try:
+            async with app.test_request_context(path, method='GET') as ctx:
+                r = await app.full_dispatch_request(ctx)
+            body = None
+            if r.is_json:
+                body = await r.get_json()
+        except Exception:
+            # one failing request doesn't fail the others
+            log.exception("batch request %s failed", path)
+            return {'status_code': 500, 'body': None}
+        return {'status_code': r.status_code, 'body': body}
+
+    @app.route('/batch', methods=['POST'])
+    async def batch():
+        data = await request.get_json(force=True, silent=True)
+        max_size = app.config.get('MAX_BATCH_SIZE', MAX_BATCH_SIZE)
+        if not isinstance(data, dict) or not isinstance(
+                data.get('requests'), list):
+            return {'status': 'Verification error: expected a JSON object '
+                    'with a list of requests'}, 505
+        paths = data['requests']
+        if len(paths) > max_size:
+            return {'status': 'too many requests, maximum is %d' %
+                    max_size}, 505
+        urls = app.url_map.bind('localhost')
+        for path in paths:
+            if not isinstance(path, str) or not path.startswith('/'):
+                return {'status': 'invalid request path %s' % path}, 505
+            if path.split('?', 1)[0] == '/batch':
+                return {'status': "batches can't be nested"}, 505
+            try:
+                endpoint, _ = urls.match(unquote(path.split('?', 1)[0]),
+                                         method='GET')
+            except HTTPException:
+                # still dispatched, for the error response
+                continue
+            if endpoint in NOT_JSON_ENDPOINTS:
+                return {'status': "%s doesn't respond with JSON" % path}, 505
+        async with db.snapshot():
+            r = await asyncio.gather(*[batch_request(path)
+                                       for path in paths])
+        return {'status': 'OK', 'responses': r}
+
+    @app.route('/area/<int:area_id>/export')
+    async def area_export(area_id):
+        q = list(await db.execute_prepared(AREA_EXISTS, id=area_id))
+        if len(q) == 0:
+            return {'status': 'no area id %d found' % area_id}, 505
+        # written to a file first, so the read transaction (which holds a
+        # pooled connection and WAL checkpoints back) isn't paced by the client
+        fd, path = tempfile.mkstemp(suffix='.afro')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                await db.run(write_export, area_id, f)
+            f = await aiofiles.open(path, 'rb')
+        finally:
+            # the open file keeps it around until sent
+            os.unlink(path)
+        async def generate():
+            try:
+                while True:
+                    chunk = await f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                await f.close()
+        return generate(), 200, {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': 'attachment; filename=area%d.afro' % area_id
+            }
+
+    @app.route('/area/<int:area_id>/tree')
+    async def area_tree_get(area_id):
+        with_problems = request.args.get('problems', '1') != '0'
+        async with db.snapshot():
+            tree = await db.run(area_tree, area_id, with_problems)
+        if tree is None:
+            return {'status': 'no area id %d found' % area_id}, 505
+        tree['status'] = 'OK'
+        return tree
+
+    @app.route('/search')
+    async def search():
+        if 'q' not in request.args:
+            return {'status': 'Query not passed, please pass q parameter'}, 505
+        try:
+            limit = int(request.args.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            return {'status': 'limit must be an integer'}, 505
+        if limit < 1:
+            # SQLite takes a negative LIMIT as no limit at all
+            return {'status': 'limit must be positive'}, 505
+        limit = min(limit, MAX_LIMIT)
+        match = match_expression(request.args['q'])
+        if match is None:
+            return {'status': 'OK', 'results': []}
+        q = await db.execute(SEARCH, match=match, limit=limit)
+        return {'status': 'OK', 'results': [search_result(x) for x in q]}
+
+    @app.route('/sync')
+    async def sync():
+        try:
+            since = int(request.args.get('since', 0))
+        except ValueError:
+            return {'status': 'since must be an integer'}, 505
+        try:
+            # a read, the deferred snapshot doesn't take the write lock
+            async with db.snapshot():
+                r = await db.run(sync_changes, since)
+        except ValueError as e:
+            return {'status': str(e)}, 505
+        r['status'] = 'OK'
+        return r
+
     @app.route('/problem/add', methods=['POST'])
-    @wrap(required_args=dict(block=int), optional_args=dict(
-        name=str,
-        description=str,
-        grade=str
-    ))
+    @wrap(required_args=PROBLEM_ARGS, optional_args=PROBLEM_OPTIONAL_ARGS)
     async def problem_add(parameters):
-        r = db.execute(problem.insert().values(**parameters))
-        return {'id': r.inserted_primary_key[0]}
+        problem_id = await db.transaction(insert_problem, parameters,
+                                          db.compiled_cache)
+        cache.invalidate(('block', parameters['block']))
+        return {'id': problem_id}
 
     @app.route('/problem/<int:problem_id>')
+    @cached('problem')
     async def problem_get(problem_id):
-        q = list(db.execute(
-            select([problem.c.block, problem.c.name, problem.c.description,
-            problem.c.grade]).where(problem.c.id == problem_id)))
+        q = list(await db.execute_prepared(PROBLEM_GET, id=problem_id))
         if len(q) == 0:
             return {'status': 'no problem id %s found' % problem_id}, 505
         assert len(q) == 1
@@ -211,118 +878,169 @@ def register_routes(app, state):
                 'description': q[2], 'grade': q[3]}
 
     @app.route('/problem/<int:problem_id>/photos')
+    @cached('problem_photos')
     async def problem_get_photos(problem_id):
-        q = list(db.execute(select([problem.c.id]).where(
-            problem.c.id == problem_id)))
+        q = list(await db.execute_prepared(PROBLEM_EXISTS, id=problem_id))
         if len(q) == 0:
             return {'status': 'no problem id %d found' % problem_id}, 505
-        q = list(db.execute(select([photo_problem.c.photo]).where(
-                 photo_problem.c.problem == q[0][0])))
+        q = list(await db.execute_prepared(PROBLEM_PHOTOS, problem=q[0][0]))
         return {'status': 'OK', 'photos': [x[0] for x in q]}
 
     @app.route('/photo/add', methods=['POST'])
     async def photo_add():
-        data = await request.data
-        r = list(db.execute(select([func.count(photo)])))
-        last_photo = r[0][0]
-        photo_file = "photo%d.jpg" % (last_photo,)
-        with app.config['tmpdir'].join(photo_file).open('wb') as f:
-            f.write(data)
-        db.execute(photo.insert().values({'filename': photo_file}))
+        max_size = app.config.get('MAX_PHOTO_SIZE', MAX_PHOTO_SIZE)
+        if (request.content_length is not None and
+            request.content_length > max_size):
+            return {'status': 'photo too big, maximum size is %d bytes' %
+                    max_size}, 413
+        photo_dir = str(app.config['tmpdir'])
+        fd, tmp_path = tempfile.mkstemp(dir=photo_dir, suffix='.part')
+        os.close(fd)
+        try:
+            size = 0
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in request.body:
+                    size += len(chunk)
+                    if size > max_size:
+                        return {'status': 'photo too big, maximum size is '
+                                '%d bytes' % max_size}, 413
+                    await f.write(chunk)
+            for i in range(PHOTO_ADD_RETRIES):
+                try:
+                    photo_file = await db.transaction(claim_photo, tmp_path,
+                                                      photo_dir)
+                    break
+                except (IntegrityError, OperationalError):
+                    # someone else claimed the same name or holds the lock
+                    if i == PHOTO_ADD_RETRIES - 1:
+                        raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        if derivatives.enabled:
+            app.add_background_task(derivatives.generate_all,
+                os.path.join(photo_dir, photo_file), derivative_dir())
         return {'status': 'OK', 'filename': photo_file}
 
     @app.route('/photo/associate', methods=['POST'])
     @wrap(required_args=dict(photo_filename=str, id=int, type=str))
     async def photo_associate(parameters):
         photo_filename = parameters['photo_filename']
-        q = list(db.execute(select([photo.c.filename]).where(
-            photo.c.filename == photo_filename)))
+        q = list(await db.execute_prepared(PHOTO_EXISTS,
+                                           filename=photo_filename))
         if len(q) == 0:
             return {'status': 'photo %s not found' % photo_filename}, 505
         tp = parameters['type']
         id = parameters['id']
         if tp == 'problem':
-            q = list(db.execute(select([problem.c.id]).where(
-                problem.c.id == id)))
+            q = list(await db.execute_prepared(PROBLEM_EXISTS, id=id))
             if len(q) == 0:
                 return {'status': 'unknown problem id %d' % id}, 505
-            db.execute(photo_problem.insert().values({
-                'photo': photo_filename,
-                'problem': id
-                }))
+            await db.execute_prepared(PHOTO_PROBLEM_INSERT,
+                                      photo=photo_filename, problem=id)
+            cache.invalidate(('problem_photos', id))
             return {'status': 'OK'}
         elif tp == 'block':
-            q = list(db.execute(select([block.c.id]).where(
-                block.c.id == id)))
+            q = list(await db.execute_prepared(BLOCK_EXISTS, id=id))
             if len(q) == 0:
                 return {'status': 'unknown block id %d' % id}, 505
-            db.execute(photo_block.insert().values({
-                'photo': photo_filename,
-                'block': id
-                }))
+            await db.execute_prepared(PHOTO_BLOCK_INSERT,
+                                      photo=photo_filename, block=id)
+            cache.invalidate(('block_photos', id))
             return {'status': 'OK'}
         else:
             return {'status': 'unknown type %s' % parameters['type']}, 505
 
+    @app.route('/photo/many')
+    async def photo_get_many():
+        if 'f' not in request.args:
+            return {'status': 'Photos not passed, please pass f parameter'}, 505
+        photo_filenames = [x for x in request.args['f'].split(',') if x]
+        try:
+            tolerance = parse_tolerance(request.args)
+        except ValueError as e:
+            return {'status': str(e)}, 505
+        photos = await get_photo_lines(db, photo_filenames, tolerance)
+        missing = [x for x in photo_filenames if x not in photos]
+        if missing:
+            return {'status': 'photos not found: %s' % ','.join(missing)}, 505
+        return {'status': 'OK', 'photos': [
+            {
+                'filename': photo_filename,
+                'type': 'jpg',
+                'lines': photos[photo_filename]
+            } for photo_filename in photo_filenames]
+        }
+
     @app.route('/photo/<photo_filename>')
+    @cached('photo')
     async def photo_get(photo_filename):
-        q = list(db.execute(select([photo.c.filename]).where(
-            photo.c.filename == photo_filename)))
-        if len(q) == 0:
+        try:
+            tolerance = parse_tolerance(request.args)
+        except ValueError as e:
+            return {'status': str(e)}, 505
+        photos = await get_photo_lines(db, [photo_filename], tolerance)
+        if photo_filename not in photos:
             return {'status': 'photo not found'}, 505
-        lines = list(db.execute(select([line.c.id, line.c.problem]).where(
-            line.c.photo == photo_filename)))
-        return {'status': 'OK', 'type': 'jpg', 'lines': [
-            {
-                'id': line_id,
-                'problem': problem_id,
-                'points': get_all_points(db, line_id)
-            } for (line_id, problem_id) in lines]
-        }
+        return {'status': 'OK', 'type': 'jpg',
+                'lines': photos[photo_filename]}
 
     @app.route('/photo/raw/<photo_filename>')
     async def photo_raw_get(photo_filename):
-        q = list(db.execute(select([photo.c.filename]).where(
-            photo.c.filename == photo_filename)))
+        q = list(await db.execute_prepared(PHOTO_EXISTS,
+                                           filename=photo_filename))
         if len(q) == 0:
             return "", 404
-        return open(app.config['tmpdir'].join(photo_filename), 'rb').read()
+        path = str(app.config['tmpdir'].join(photo_filename))
+        if 'w' in request.args:
+            fmt = request.args.get('format', 'jpg')
+            if request.args['w'] not in [str(x) for x in WIDTHS]:
+                return {'status': 'unsupported width %s, supported: %s' % (
+                    request.args['w'], ', '.join(map(str, WIDTHS)))}, 505
+            if fmt not in FORMATS:
+                return {'status': 'unsupported format %s' % fmt}, 505
+            if derivatives.enabled:
+                try:
+                    path = await derivatives.get(path, derivative_dir(),
+                        int(request.args['w']), fmt)
+                except OSError as e:
+                    # not something we can resize, serve the original
+                    log.warning("can't resize %s: %s", photo_filename, e)
+        r = await send_file(path,
+            conditional=True, cache_timeout=app.config.get(
+                'PHOTO_CACHE_TIMEOUT', PHOTO_CACHE_TIMEOUT))
+        # a filename always refers to the same photo
+        r.cache_control.immutable = True
+        return r
 
     @app.route('/line/add', methods=['POST'])
-    @wrap(required_args=dict(
-        problem=int,
-        point_list=point_list_verifier,
-        photo_filename=str
-        ))
+    @wrap(required_args=LINE_ARGS)
     async def line_add(parameters):
         problem_id = parameters['problem']
         photo_filename = parameters['photo_filename']
-        r = list(db.execute(select([problem.c.id]).where(problem.c.id == problem_id)))
+        r = list(await db.execute_prepared(PROBLEM_EXISTS, id=problem_id))
         if len(r) == 0:
             return {'status': "can't find problem id %d" % problem_id}, 505
-        r = list(db.execute(select([photo.c.filename]).where(photo.c.filename == photo_filename)))
+        r = list(await db.execute_prepared(PHOTO_EXISTS,
+                                           filename=photo_filename))
         if len(r) == 0:
             return {'status': "can't find photo filename %s" % photo_filename}, 505
-        r = db.execute(line.insert().values({
-            'problem': problem_id,
-            'photo': photo_filename
-            }))
-        line_id = r.lastrowid
-        for i, (x, y) in enumerate(parameters['point_list']):
-            db.execute(point.insert().values({
-                'line_id': line_id,
-                'index': i,
-                'x': x,
-                'y': y
-                }))
-        return {'status': 'OK', 'id': line_id}
+        # simplification levels are worked out here, reads only filter
+        points, importance = pack_line(parameters['point_list'])
+        r = await db.execute_prepared(LINE_INSERT, problem=problem_id,
+            photo=photo_filename, points=points, importance=importance)
+        cache.invalidate(('photo', photo_filename))
+        return {'status': 'OK', 'id': r.inserted_primary_key[0]}
 
     @app.route('/line/<int:line_id>')
     async def line_get(line_id):
-        r = list(db.execute(select([line.c.id]).where(line.c.id == line_id)))
+        try:
+            tolerance = parse_tolerance(request.args)
+        except ValueError as e:
+            return {'status': str(e)}, 505
+        r = list(await db.execute_prepared(LINE_GET, id=line_id))
         if len(r) == 0:
             return {'status': "can't find line ID %d" % line_id}, 505
-        points = get_all_points(db, line_id)
-        return {'status': 'OK', 'points': points}
+        return {'status': 'OK', 'points': line_points(*r[0], tolerance)}
 
     return app
@@ -0,0 +1,264 @@
+
+""" Compact binary export of a whole area, for offline use and for seeding
+databases.
+
+An archive is a gzip stream starting with MAGIC, followed by records and an
+end marker. A record is its kind (one byte), a varint bitmap of null fields
+and the fields of the kind as listed in KINDS: zigzag varints for integers,
+little endian doubles for floats and varint length prefixed bytes for
+strings and blobs. Parents always come before their children.
+"""
+
+import gzip
+import struct
+import zlib
+
+from sqlalchemy import select, union
+
+from afro.clusters import update_clusters, update_cluster_grades
+from afro.db import allocate_ids
+from afro.geometry import line_importance, pack_floats, unpack_points
+from afro.grades import grade_rank
+from afro.model import (area, sector, block, problem, photo, photo_problem,
+                        photo_block, line)
+
+MAGIC = b'AFRO\x01'
+END = b'E'
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 500
+
+# kind code -> (table, [(column, type)]), in the order they are written
+KINDS = {
+    b'A': (area, [('id', 'i'), ('name', 's'), ('description', 's'),
+                  ('lat', 'f'), ('lon', 'f')]),
+    b'S': (sector, [('id', 'i'), ('area', 'i'), ('name', 's'),
+                    ('description', 's'), ('lat', 'f'), ('lon', 'f')]),
+    b'B': (block, [('id', 'i'), ('sector', 'i'), ('name', 's'),
+                   ('description', 's'), ('lat', 'f'), ('lon', 'f')]),
+    b'P': (problem, [('id', 'i'), ('block', 'i'), ('name', 's'),
+                     ('description', 's'), ('grade', 's')]),
+    b'F': (photo, [('filename', 's')]),
+    b'b': (photo_block, [('photo', 's'), ('block', 'i')]),
+    b'p': (photo_problem, [('photo', 's'), ('problem', 'i')]),
+    b'L': (line, [('id', 'i'), ('photo', 's'), ('problem', 'i'),
+                  ('points', 'b')]),
+}
+
+class ArchiveError(Exception):
+    pass
+
+def encode_uvarint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def encode_record(kind, fields, row, out):
+    out += kind
+    nulls = 0
+    for i, (name, _) in enumerate(fields):
+        if row[i] is None:
+            nulls |= 1 << i
+    encode_uvarint(nulls, out)
+    for value, (name, tp) in zip(row, fields):
+        if value is None:
+            continue
+        if tp == 'i':
+            encode_uvarint((value << 1) ^ (value >> 63), out)
+        elif tp == 'f':
+            out += struct.pack('<d', value)
+        else:
+            if tp == 's':
+                value = value.encode('utf8')
+            encode_uvarint(len(value), out)
+            out += value
+
+def area_queries(area_id):
+    """ Queries for all the rows of every kind belonging to the area
+    """
+    sectors = select([sector.c.id]).where(sector.c.area == area_id)
+    blocks = select([block.c.id]).where(block.c.sector.in_(sectors))
+    problems = select([problem.c.id]).where(problem.c.block.in_(blocks))
+    photos = union(
+        select([photo_block.c.photo]).where(photo_block.c.block.in_(blocks)),
+        select([photo_problem.c.photo]).where(
+            photo_problem.c.problem.in_(problems)),
+        select([line.c.photo]).where(line.c.problem.in_(problems)))
+    where = {
+        b'A': area.c.id == area_id,
+        b'S': sector.c.area == area_id,
+        b'B': block.c.sector.in_(sectors),
+        b'P': problem.c.block.in_(blocks),
+        b'F': photo.c.filename.in_(photos),
+        b'b': photo_block.c.block.in_(blocks),
+        b'p': photo_problem.c.problem.in_(problems),
+        b'L': line.c.problem.in_(problems),
+    }
+    for kind, (table, fields) in KINDS.items():
+        columns = [table.c[name] for name, _ in fields]
+        yield kind, fields, select(columns).where(where[kind])
+
+def export_area(con, area_id, chunk_size=CHUNK_SIZE):
+    """ Generate the gzipped archive of the area in chunks of about
+    chunk_size bytes, reading rows from the cursor as it goes. All the
+    queries run in one transaction, so children written meanwhile can't
+    show up without their parents
+    """
+    compressor = zlib.compressobj(wbits=31)
+    out = bytearray(MAGIC)
+    with con.begin():
+        for kind, fields, q in area_queries(area_id):
+            for row in con.execute(q):
+                encode_record(kind, fields, row, out)
+                if len(out) >= chunk_size:
+                    chunk = compressor.compress(bytes(out))
+                    out.clear()
+                    if chunk:
+                        yield chunk
+    out += END
+    yield compressor.compress(bytes(out)) + compressor.flush()
+
+def write_export(con, area_id, f):
+    """ Write the archive of the area to file object f
+    """
+    for chunk in export_area(con, area_id):
+        f.write(chunk)
+
+class Reader:
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise ArchiveError("truncated archive")
+        return data
+
+    def uvarint(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self.read(1)[0]
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def record(self, fields):
+        nulls = self.uvarint()
+        row = {}
+        for i, (name, tp) in enumerate(fields):
+            if nulls & (1 << i):
+                row[name] = None
+            elif tp == 'i':
+                n = self.uvarint()
+                row[name] = (n >> 1) ^ -(n & 1)
+            elif tp == 'f':
+                row[name] = struct.unpack('<d', self.read(8))[0]
+            else:
+                value = self.read(self.uvarint())
+                if tp == 's':
+                    value = value.decode('utf8')
+                row[name] = value
+        return row
+
+def read_records(f):
+    """ Iterate over (kind, row dict) of an archive in file object f
+    """
+    r = Reader(gzip.GzipFile(fileobj=f, mode='rb'))
+    try:
+        if r.read(len(MAGIC)) != MAGIC:
+            raise ArchiveError("not an afro archive")
+        while True:
+            kind = r.read(1)
+            if kind == END:
+                return
+            if kind not in KINDS:
+                raise ArchiveError("unknown record kind %r" % kind)
+            yield kind, r.record(KINDS[kind][1])
+    except (EOFError, OSError, zlib.error, UnicodeDecodeError) as e:
+        raise ArchiveError("corrupted archive: %s" % e)
+
+class Importer:
+    """ Insert records into the database in batches, giving entities new IDs
+    and remapping references to them. Only the ID maps are kept in memory
+    """
+    # kind -> [(column, kind of the referenced entity)]
+    REFERENCES = {
+        b'S': [('area', b'A')],
+        b'B': [('sector', b'S')],
+        b'P': [('block', b'B')],
+        b'b': [('block', b'B')],
+        b'p': [('problem', b'P')],
+        b'L': [('problem', b'P')],
+    }
+
+    def __init__(self, con, batch_size=BATCH_SIZE):
+        self.con = con
+        self.batch_size = batch_size
+        self.ids = {kind: {} for kind in KINDS}
+        self.kind = None
+        self.batch = []
+
+    def add(self, kind, row):
+        if kind != self.kind:
+            self.flush()
+            self.kind = kind
+        for column, ref_kind in self.REFERENCES.get(kind, ()):
+            old = row[column]
+            if old is not None:
+                if old not in self.ids[ref_kind]:
+                    raise ArchiveError("%s %d of %s not in the archive" % (
+                        column, old, KINDS[kind][0].name))
+                row[column] = self.ids[ref_kind][old]
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        table = KINDS[self.kind][0]
+        rows = self.batch
+        self.batch = []
+        if self.kind == b'F':
+            existing = {x[0] for x in self.con.execute(
+                select([photo.c.filename]).where(
+                photo.c.filename.in_([row['filename'] for row in rows])))}
+            rows = [row for row in rows if row['filename'] not in existing]
+            if not rows:
+                return
+        elif 'id' in table.c:
+            ids = self.ids[self.kind]
+            for new_id, row in zip(allocate_ids(self.con, table, len(rows)),
+                                   rows):
+                ids[row['id']] = new_id
+                row['id'] = new_id
+        if self.kind == b'L':
+            # derived, so not in the archive
+            for row in rows:
+                row['importance'] = pack_floats(line_importance(
+                    unpack_points(row['points'])))
+        elif self.kind == b'P':
+            for row in rows:
+                row['grade_rank'] = grade_rank(row['grade'])
+        self.con.execute(table.insert(), rows)
+        if self.kind == b'B':
+            update_clusters(self.con, [(row['lat'], row['lon'])
+                                       for row in rows], 1)
+        elif self.kind == b'P':
+            update_cluster_grades(self.con, [(row['block'], row['grade_rank'])
+                                             for row in rows], 1)
+
+def import_archive(con, f):
+    """ Import the archive in file object f, meant to be run within a
+    transaction. Returns the number of imported records per table
+    """
+    importer = Importer(con)
+    counts = {}
+    for kind, row in read_records(f):
+        importer.add(kind, row)
+        name = KINDS[kind][0].name
+        counts[name] = counts.get(name, 0) + 1
+    importer.flush()
+    return counts
@@ -0,0 +1,77 @@
+
+import os
+import time
+from collections import OrderedDict
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 300
+
+class ResponseCache:
+    """ Bounded LRU cache of responses with a time to live. Entries belong to
+    an entity key, e.g. ('block', 3), and can have several variants (like
+    different query strings). Every entity has a version number which is
+    bumped by invalidate(), making it usable as an ETag.
+
+    Versions are per process, etags carry a random per process prefix so
+    they never match across restarts. Only the size most recently used
+    versions are kept, evicted keys fall back to a floor which is above
+    every version evicted so far, so their old etags don't match again.
+    """
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.variants = {}
+        self.versions = OrderedDict()
+        self.floor = 0
+        self.prefix = os.urandom(4).hex()
+
+    def version(self, key):
+        return self.versions.get(key, self.floor)
+
+    def etag(self, key):
+        return '%s-%s-%d' % (self.prefix, '-'.join(map(str, key)),
+                             self.version(key))
+
+    def get(self, key, variant):
+        entry = self.entries.get((key, variant))
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires < self.clock():
+            self._remove((key, variant))
+            return None
+        self.entries.move_to_end((key, variant))
+        return response
+
+    def put(self, key, variant, version, response):
+        """ Store response, unless the entity was invalidated since version
+        was read, in which case the response might be stale already
+        """
+        if self.size <= 0 or version != self.version(key):
+            return
+        self.entries[(key, variant)] = (self.clock() + self.ttl, response)
+        self.entries.move_to_end((key, variant))
+        self.variants.setdefault(key, set()).add(variant)
+        if key in self.versions:
+            self.versions.move_to_end(key)
+        while len(self.entries) > self.size:
+            self._remove(next(iter(self.entries)))
+
+    def invalidate(self, key):
+        self.versions[key] = self.version(key) + 1
+        self.versions.move_to_end(key)
+        while len(self.versions) > max(self.size, 0):
+            _, version = self.versions.popitem(last=False)
+            self.floor = max(self.floor, version + 1)
+        for variant in self.variants.pop(key, ()):
+            del self.entries[(key, variant)]
+
+    def _remove(self, entry_key):
+        del self.entries[entry_key]
+        key, variant = entry_key
+        variants = self.variants[key]
+        variants.discard(variant)
+        if not variants:
+            del self.variants[key]
@@ -0,0 +1,110 @@
+
+import math
+
+from sqlalchemy import select, text
+
+from afro.grades import rank_label
+from afro.model import block, block_cluster
+
+MAX_ZOOM = 18
+
+UPSERT = text(
+    "INSERT INTO block_cluster (zoom, x, y, count, sum_lat, sum_lon, "
+    "graded, sum_rank, sum_rank2) "
+    "VALUES (:zoom, :x, :y, :count, :sum_lat, :sum_lon, "
+    ":graded, :sum_rank, :sum_rank2) "
+    "ON CONFLICT (zoom, x, y) DO UPDATE SET "
+    "count = count + excluded.count, "
+    "sum_lat = sum_lat + excluded.sum_lat, "
+    "sum_lon = sum_lon + excluded.sum_lon, "
+    "graded = graded + excluded.graded, "
+    "sum_rank = sum_rank + excluded.sum_rank, "
+    "sum_rank2 = sum_rank2 + excluded.sum_rank2")
+
+DELETE_EMPTY = text(
+    "DELETE FROM block_cluster WHERE zoom = :zoom AND x = :x AND y = :y "
+    "AND count <= 0")
+
+def cell(lat, lon, zoom):
+    """ Grid cell of lat, lon at zoom. Zoom 0 is one cell for the whole
+    world, each zoom level splits cells in four
+    """
+    n = 1 << zoom
+    x = int(math.floor((lon + 180.0) / 360.0 * n))
+    y = int(math.floor((lat + 90.0) / 180.0 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def _update(con, points, delta):
+    """ Add or remove (lat, lon, blocks, grade ranks) to all zoom levels """
+    rows = []
+    for lat, lon, blocks, ranks in points:
+        if lat is None or lon is None:
+            continue
+        ranks = [x for x in ranks if x is not None]
+        counts = {'count': blocks * delta,
+                  'sum_lat': lat * blocks * delta,
+                  'sum_lon': lon * blocks * delta,
+                  'graded': len(ranks) * delta,
+                  'sum_rank': sum(ranks) * delta,
+                  'sum_rank2': sum(x * x for x in ranks) * delta}
+        for zoom in range(MAX_ZOOM + 1):
+            x, y = cell(lat, lon, zoom)
+            rows.append(dict(counts, zoom=zoom, x=x, y=y))
+    if not rows:
+        return
+    con.execute(UPSERT, rows)
+    if delta < 0:
+        con.execute(DELETE_EMPTY, rows)
+
+def update_clusters(con, points, delta, ranks=None):
+    """ Add (delta=1) or remove (delta=-1) blocks at the given (lat, lon)
+    points to the clusters of all the zoom levels. ranks, if given, has the
+    grade ranks of the problems on every block, which go along with it
+    """
+    if ranks is None:
+        ranks = [()] * len(points)
+    _update(con, [(lat, lon, 1, r) for (lat, lon), r in zip(points, ranks)],
+            delta)
+
+def update_cluster_grades(con, problems, delta):
+    """ Add or remove the grade ranks of problems, (block id, rank) pairs,
+    to the clusters of their blocks
+    """
+    ranks = {}
+    for block_id, rank in problems:
+        if rank is not None:
+            ranks.setdefault(block_id, []).append(rank)
+    if not ranks:
+        return
+    q = con.execute(select([block.c.id, block.c.lat, block.c.lon]).where(
+        block.c.id.in_(list(ranks))))
+    _update(con, [(lat, lon, 0, ranks[id]) for id, lat, lon in q], delta)
+
+def grade_spread(graded, sum_rank, sum_rank2):
+    """ Mean and standard deviation of the grade ranks of a cluster, with
+    the grades a standard deviation below and above the mean. None if no
+    problem has a known grade
+    """
+    if not graded:
+        return None
+    mean = sum_rank / graded
+    stddev = math.sqrt(max(sum_rank2 / graded - mean * mean, 0.0))
+    return {
+        'count': graded,
+        'mean': mean,
+        'stddev': stddev,
+        'grade': rank_label(int(round(mean))),
+        'low': rank_label(max(int(round(mean - stddev)), 0)),
+        'high': rank_label(int(round(mean + stddev)))
+        }
+
+def clusters_query(minlat, minlon, maxlat, maxlon, zoom):
+    x0, y0 = cell(minlat, minlon, zoom)
+    x1, y1 = cell(maxlat, maxlon, zoom)
+    return select([block_cluster.c.count, block_cluster.c.sum_lat,
+                   block_cluster.c.sum_lon, block_cluster.c.graded,
+                   block_cluster.c.sum_rank, block_cluster.c.sum_rank2]).where(
+        (block_cluster.c.zoom == zoom) &
+        block_cluster.c.x.between(x0, x1) &
+        block_cluster.c.y.between(y0, y1)).order_by(
+        block_cluster.c.x, block_cluster.c.y)
@@ -1,9 +1,258 @@
 
-from sqlalchemy import create_engine
+import asyncio
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, select, func, event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+STREAM_CHUNK_SIZE = 500
+# prepared statements kept by each SQLite connection, keyed by the SQL
+SQLITE_CACHED_STATEMENTS = 256
+
+# set on every new SQLite connection, DATABASE_PRAGMAS in the config
+# overrides them, None leaves the SQLite default
+DEFAULT_PRAGMAS = {
+    # readers don't block the writer and the other way around
+    'journal_mode': 'wal',
+    # with WAL only checkpoints need to fsync, still safe against corruption
+    'synchronous': 'normal',
+    # milliseconds to wait for a lock held by another process
+    'busy_timeout': 5000,
+    # negative is in KiB, per connection
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+def sqlite_pragmas(pragmas):
+    def connect(dbapi_con, connection_record):
+        # transactions are started by the begin listener below instead of
+        # the driver, so they can be BEGIN IMMEDIATE
+        dbapi_con.isolation_level = None
+        cursor = dbapi_con.cursor()
+        for name, value in pragmas.items():
+            if value is not None:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return connect
+
+def sqlite_begin(con):
+    # a deferred transaction that reads and then writes fails right away
+    # with "database is locked" if another one wrote in between, instead of
+    # waiting for busy_timeout. Write transactions take the lock upfront
+    con.execute(con.info.pop('begin', 'BEGIN'))
+
+class Result:
+    """ Fully fetched result of a statement, safe to use after the
+    connection went back to the pool
+    """
+    def __init__(self, r):
+        self.rowcount = r.rowcount
+        if r.returns_rows:
+            self.rows = r.fetchall()
+        else:
+            self.rows = []
+        if r.is_insert and not r.context.executemany:
+            self.inserted_primary_key = r.inserted_primary_key
+            self.lastrowid = r.lastrowid
+        r.close()
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def first(self):
+        if self.rows:
+            return self.rows[0]
+        return None
+
+    def scalar(self):
+        if self.rows:
+            return self.rows[0][0]
+        return None
+
+def _execute(con, stmt, multiparams, params):
+    return Result(con.execute(stmt, *multiparams, **params))
+
+def _execute_prepared(con, stmt, params, compiled_cache):
+    return Result(con.execution_options(compiled_cache=compiled_cache).execute(
+        stmt, params))
+
+class Database:
+    """ Awaitable wrapper around a pooled engine. Statements run on a
+    bounded thread pool, so a slow query only ties up one worker thread
+    and never the event loop
+    """
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE,
+                 max_overflow=DEFAULT_MAX_OVERFLOW,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT, pragmas=None):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            # an in-memory database only exists within a single connection,
+            # share it and serialize access to it
+            self.engine = create_engine(url, poolclass=StaticPool,
+                connect_args={'check_same_thread': False,
+                              'cached_statements': SQLITE_CACHED_STATEMENTS})
+            workers = 1
+            self.shared = True
+        else:
+            kwds = {}
+            if url.startswith('sqlite'):
+                # connections are handed between worker threads
+                kwds['connect_args'] = {'check_same_thread': False,
+                    'cached_statements': SQLITE_CACHED_STATEMENTS}
+            self.engine = create_engine(url, poolclass=QueuePool,
+                pool_size=pool_size, max_overflow=max_overflow,
+                pool_timeout=pool_timeout, **kwds)
+            workers = pool_size + max_overflow
+            self.shared = False
+        self.sqlite = url.startswith('sqlite')
+        if self.sqlite:
+            event.listen(self.engine, 'connect', sqlite_pragmas(
+                dict(DEFAULT_PRAGMAS, **(pragmas or {}))))
+            event.listen(self.engine, 'begin', sqlite_begin)
+        # only ever holds the statements passed to execute_prepared, which
+        # are built once, so it doesn't grow
+        self.compiled_cache = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='afro-db')
+        self.current_snapshot = contextvars.ContextVar('snapshot',
+                                                       default=None)
+
+    def in_executor(self, fn, *args):
+        """ Run fn(*args) in a worker thread. Unlike plain run_in_executor
+        this carries over context variables, e.g. the request's metrics
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    contextvars.copy_context().run, fn, *args)
+
+    def _run(self, fn, args, transaction):
+        with self.engine.connect() as con:
+            if transaction:
+                if self.sqlite:
+                    con.info['begin'] = 'BEGIN IMMEDIATE'
+                with con.begin():
+                    return fn(con, *args)
+            return fn(con, *args)
+
+    async def _submit(self, fn, args, transaction):
+        snapshot = self.current_snapshot.get()
+        if snapshot is not None:
+            # already within the snapshot's transaction
+            return await snapshot.submit(fn, *args)
+        return await self.in_executor(self._run, fn, args, transaction)
+
+    async def run(self, fn, *args):
+        """ Run fn(connection, *args) on a pooled connection in a worker
+        thread
+        """
+        return await self._submit(fn, args, False)
+
+    async def transaction(self, fn, *args):
+        """ Like run, but fn is executed within a single transaction that
+        is rolled back if fn raises
+        """
+        return await self._submit(fn, args, True)
+
+    async def execute(self, stmt, *multiparams, **params):
+        return await self.run(_execute, stmt, multiparams, params)
+
+    async def execute_prepared(self, stmt, **params):
+        """ Execute one of the statements in afro.statements, or any other
+        built once with bound parameters, compiling it only the first time
+        """
+        return await self.run(_execute_prepared, stmt, params,
+                              self.compiled_cache)
+
+    async def stream(self, make_stmt, after=None, limit=None,
+                     chunk_size=STREAM_CHUNK_SIZE):
+        """ Asynchronously iterate over rows ordered by their first column,
+        an id, fetching chunk_size of them at a time with the statement
+        make_stmt(after, limit) returns. Every chunk is a separate query, so
+        the connection goes back to the pool in between and a slow reader
+        can't hold it for long
+        """
+        while limit is None or limit > 0:
+            n = chunk_size if limit is None else min(chunk_size, limit)
+            rows = (await self.execute(make_stmt(after, n))).rows
+            for row in rows:
+                yield row
+            if len(rows) < n:
+                break
+            after = rows[-1][0]
+            if limit is not None:
+                limit -= n
+
+    @contextlib.asynccontextmanager
+    async def snapshot(self):
+        """ Within the block, all database access of the current task and
+        tasks started from it goes through one connection and transaction,
+        so it sees a consistent view of the data. An in-memory database only
+        has one connection anyway, so there is no isolation to get there
+        """
+        if self.current_snapshot.get() is not None:
+            yield
+            return
+        snapshot = Snapshot(self)
+        await snapshot.start()
+        token = self.current_snapshot.set(snapshot)
+        try:
+            yield
+        finally:
+            self.current_snapshot.reset(token)
+            await snapshot.finish()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
+
+class Snapshot:
+    """ One connection with an open transaction, used by one statement at a
+    time
+    """
+    def __init__(self, db):
+        self.db = db
+        self.lock = asyncio.Lock()
+        self.con = None
+        self.trans = None
+
+    async def submit(self, fn, *args):
+        async with self.lock:
+            return await self.db.in_executor(fn, self.con, *args)
+
+    async def start(self):
+        self.con = await self.db.in_executor(self.db.engine.connect)
+        if not self.db.shared:
+            self.trans = await self.submit(lambda con: con.begin())
+
+    async def finish(self):
+        if self.trans is not None:
+            await self.submit(lambda con: self.trans.commit())
+        await self.submit(lambda con: con.close())
+
+def allocate_ids(con, table, n):
+    """ Reserve n consecutive primary keys of table, so rows can be inserted
+    with executemany and still be referenced. Only safe within a transaction
+    """
+    start = con.execute(select([func.max(table.c.id)])).scalar() or 0
+    return list(range(start + 1, start + n + 1))
 
 def get_db(app, state):
 
-    if not hasattr(state, 'con'):
-        state.engine = create_engine(app.config['DATABASE'])
-        state.con = state.engine.connect()
-    return state.con
+    if not hasattr(state, 'db'):
+        config = app.config
+        state.db = Database(config['DATABASE'],
+            pool_size=config.get('DATABASE_POOL_SIZE', DEFAULT_POOL_SIZE),
+            max_overflow=config.get('DATABASE_MAX_OVERFLOW',
+                                    DEFAULT_MAX_OVERFLOW),
+            pool_timeout=config.get('DATABASE_POOL_TIMEOUT',
+                                    DEFAULT_POOL_TIMEOUT),
+            pragmas=config.get('DATABASE_PRAGMAS'))
+        state.engine = state.db.engine
+    return state.db
@@ -0,0 +1,101 @@
+
+import asyncio
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+WIDTHS = (320, 640, 1280)
+FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP'}
+QUALITY = 80
+DEFAULT_CONCURRENCY = 2
+
+def derivative_filename(photo_filename, width, fmt):
+    return '%s-%d.%s' % (os.path.splitext(photo_filename)[0], width, fmt)
+
+def resize(src, dst, width, fmt):
+    """ Write a copy of src scaled down to width into dst, run in a worker
+    process
+    """
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.width > width:
+            im = im.resize((width, max(1, round(im.height * width / im.width))),
+                           Image.LANCZOS)
+        if fmt == 'jpg' and im.mode != 'RGB':
+            im = im.convert('RGB')
+        # unique, other worker processes might be writing the same dst
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst),
+            prefix=os.path.basename(dst) + '.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                im.save(f, FORMATS[fmt], quality=QUALITY)
+            os.replace(tmp, dst)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    return dst
+
+class Derivatives:
+    """ Resized versions of photos, generated on a process pool and cached
+    on disk. At most `concurrency` resizes run at the same time and
+    concurrent requests for the same derivative share the work
+    """
+    def __init__(self, workers=None, concurrency=DEFAULT_CONCURRENCY):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.executor = None
+        self.semaphore = None
+        self.pending = {}
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    async def _resize(self, src, dst, width, fmt):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, resize, src, dst,
+                                              width, fmt)
+
+    async def get(self, src, cache_dir, width, fmt):
+        """ Return the path of the derivative of src, generating it if it's
+        not in the cache yet
+        """
+        dst = os.path.join(cache_dir, derivative_filename(
+            os.path.basename(src), width, fmt))
+        if os.path.exists(dst):
+            return dst
+        task = self.pending.get(dst)
+        if task is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            task = asyncio.ensure_future(self._resize(src, dst, width, fmt))
+            self.pending[dst] = task
+            task.add_done_callback(lambda t: self.pending.pop(dst, None))
+        return await asyncio.shield(task)
+
+    async def generate_all(self, src, cache_dir):
+        """ Generate all the standard derivatives of src, errors are logged
+        and otherwise ignored, the next request will retry
+        """
+        r = await asyncio.gather(*[self.get(src, cache_dir, width, fmt)
+            for width in WIDTHS for fmt in FORMATS], return_exceptions=True)
+        for x in r:
+            if isinstance(x, Exception):
+                log.warning("can't generate derivatives of %s: %s", src, x)
+                break
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,138 @@
+
+""" Response encoding: a faster JSON provider when orjson is installed and
+gzip or brotli (when installed) compression negotiated by Accept-Encoding.
+Compressed bodies of responses with an ETag are kept, so cached GETs are
+compressed only once per version
+"""
+
+import asyncio
+import gzip
+from collections import OrderedDict
+
+from quart import request
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers.response import DataBody
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_CACHE_SIZE = 1000
+# bigger bodies are compressed in a thread, not to stall the event loop
+THREAD_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE = {'application/json', 'text/plain'}
+
+class JSONProvider(DefaultJSONProvider):
+    """ Serialize with orjson if available, which is several times faster
+    than json with the float heavy line geometry. Falls back to json for
+    anything orjson can't do. Points are already rounded by
+    afro.geometry.unpack_points, so floats come out short either way
+    """
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {'separators', 'indent'}:
+            return super().dumps(obj, **kwargs)
+        option = 0
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=self.default,
+                                option=option).decode('utf8')
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+class Compressor:
+    """ Compress responses for clients accepting it, remembering up to
+    cache_size compressed bodies of responses with an ETag
+    """
+    def __init__(self, min_size=DEFAULT_MIN_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.encodings = ['gzip']
+        if brotli is not None:
+            self.encodings.insert(0, 'br')
+
+    def negotiate(self, accept):
+        """ Best encoding of those accepted, None for identity """
+        encoding = accept.best_match(self.encodings)
+        if encoding is None or accept[encoding] <= 0:
+            return None
+        return encoding
+
+    async def compressed(self, data, encoding, key):
+        if key is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                self.cache.move_to_end(key)
+                return body
+        if len(data) >= THREAD_SIZE:
+            loop = asyncio.get_event_loop()
+            body = await loop.run_in_executor(None, compress, data, encoding)
+        else:
+            body = compress(data, encoding)
+        if key is not None and self.cache_size > 0:
+            self.cache[key] = body
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return body
+
+    async def encode(self, response):
+        if (response.mimetype not in COMPRESSIBLE or
+                not isinstance(response.response, DataBody) or
+                'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+        data = await response.get_data()
+        if len(data) < self.min_size:
+            return response
+        key = None
+        etag, _ = response.get_etag()
+        if etag is not None:
+            key = (request.path, request.query_string, etag, encoding)
+        response.set_data(await self.compressed(data, encoding, key))
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            # same entity, different bytes, like other servers do
+            response.set_etag(etag, weak=True)
+        return response
+
+def register_encoding(app):
+    """ Use JSONProvider and, unless COMPRESS is false, compress responses
+    """
+    app.json = JSONProvider(app)
+    if not app.config.get('COMPRESS', True):
+        return None
+    compressor = Compressor(
+        min_size=app.config.get('COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE),
+        cache_size=app.config.get('COMPRESS_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+    @app.after_request
+    async def compress_response(response):
+        return await compressor.encode(response)
+
+    return compressor
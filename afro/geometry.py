@@ -0,0 +1,142 @@
+
+import math
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# points are normalized to 0-1, so 6 decimal places is way below a pixel
+# on any photo and comfortably within float32 precision
+PRECISION = 6
+
+def parse_coordinates(items):
+    """ Convert a flat list of numbers or numeric strings into (x, y) pairs
+    in one go, raises ValueError if any of them isn't a number in 0-1
+    without telling which, the caller can check them one by one for that
+    """
+    if numpy is not None:
+        try:
+            a = numpy.array(items, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            raise ValueError("not a list of numbers")
+        # None and 'nan' end up as NaN, which fails the range check too
+        if a.ndim != 1 or not ((a >= 0.0) & (a <= 1.0)).all():
+            raise ValueError("coordinates not in range")
+        return a.reshape(-1, 2)
+    try:
+        a = array('d', map(float, items))
+    except TypeError:
+        raise ValueError("not a list of numbers")
+    if not all(0.0 <= x <= 1.0 for x in a):
+        raise ValueError("coordinates not in range")
+    return list(zip(a[::2], a[1::2]))
+
+def pack_points(points):
+    """ Pack a list of (x, y) tuples (or an n x 2 array) into a blob of
+    little endian float32
+    """
+    if numpy is not None:
+        return numpy.asarray(points, dtype='<f4').tobytes()
+    a = array('f')
+    for x, y in points:
+        a.append(x)
+        a.append(y)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+def pack_floats(values):
+    """ Pack a list of floats into a blob of little endian float32
+    """
+    a = array('f', values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+def unpack_floats(data):
+    a = array('f')
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+def _segment_distances(points, a, b):
+    """ Distances of numpy points from the segment a-b """
+    ab = b - a
+    l2 = ab.dot(ab)
+    if l2 == 0:
+        d = points - a
+    else:
+        t = numpy.clip((points - a).dot(ab) / l2, 0.0, 1.0)
+        d = points - (a + t[:, None] * ab)
+    return numpy.hypot(d[:, 0], d[:, 1])
+
+def _segment_distance(p, a, b):
+    abx, aby = b[0] - a[0], b[1] - a[1]
+    l2 = abx * abx + aby * aby
+    t = 0.0
+    if l2 != 0:
+        t = min(1.0, max(0.0, ((p[0] - a[0]) * abx + (p[1] - a[1]) * aby) / l2))
+    return math.hypot(p[0] - a[0] - t * abx, p[1] - a[1] - t * aby)
+
+def line_importance(points):
+    """ Douglas-Peucker tolerance per vertex: simplifying with a tolerance
+    keeps exactly the vertices whose importance is at least that. The ends
+    are always kept. A vertex never gets more than the vertex it was split
+    off at, so the levels nest
+    """
+    n = len(points)
+    importance = [0.0] * n
+    if n == 0:
+        return importance
+    importance[0] = importance[-1] = math.inf
+    if numpy is not None:
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        i, j, cap = stack.pop()
+        if j - i < 2:
+            continue
+        if numpy is not None:
+            d = _segment_distances(points[i + 1:j], points[i], points[j])
+            k = int(d.argmax())
+            dist = float(d[k])
+        else:
+            dist, k = max((_segment_distance(p, points[i], points[j]), k)
+                          for k, p in enumerate(points[i + 1:j]))
+        k += i + 1
+        dist = min(dist, cap)
+        importance[k] = dist
+        stack.append((i, k, dist))
+        stack.append((k, j, dist))
+    return importance
+
+def simplify(points, importance, tolerance):
+    """ points of a line without the vertices less important than tolerance,
+    importance being the unpacked line_importance blob, or None if there is
+    none and the line is returned as is
+    """
+    if importance is None or tolerance is None:
+        return points
+    return [p for p, w in zip(points, importance) if w >= tolerance]
+
+def pack_line(points):
+    """ Blobs of the points and of their importance, for line.points and
+    line.importance
+    """
+    return pack_points(points), pack_floats(line_importance(points))
+
+def unpack_points(data):
+    """ Reverse of pack_points, returns a list of (x, y) tuples
+    """
+    if not data:
+        return []
+    a = array('f')
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    a = [round(x, PRECISION) for x in a]
+    return list(zip(a[::2], a[1::2]))
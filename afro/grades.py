@@ -0,0 +1,76 @@
+
+""" Bouldering grades. problem.grade stays whatever was entered, the rank
+derived from it orders Font and V-scale grades on one numeric scale so the
+database can filter and group by it. Grades that don't parse have no rank
+"""
+
+import re
+
+FONT_GRADES = ['3', '4', '4+', '5', '5+', '6A', '6A+', '6B', '6B+', '6C',
+               '6C+', '7A', '7A+', '7B', '7B+', '7C', '7C+', '8A', '8A+', '8B',
+               '8B+', '8C', '8C+', '9A']
+# ranks are Font grades STEP apart, leaving room for grades in between
+STEP = 10
+FONT_RANKS = {grade: i * STEP for i, grade in enumerate(FONT_GRADES)}
+
+# usual Font equivalents, the ones spanning two Font grades sit in between
+V_GRADES = {
+    'B': '3', '0': '4', '1': '5', '2': '5+', '3': '6A/6A+', '4': '6B/6B+',
+    '5': '6C/6C+', '6': '7A', '7': '7A+', '8': '7B/7B+', '9': '7C',
+    '10': '7C+', '11': '8A', '12': '8A+', '13': '8B', '14': '8B+',
+    '15': '8C', '16': '8C+', '17': '9A',
+}
+# V0-, V3+ and the like
+V_MODIFIER = 3
+
+FONT_RE = re.compile(r'(?:FONT|FB|F)?\s*([3-9][ABC]?\+?)$')
+V_RE = re.compile(r'V(B|\d{1,2})([+-]?)$')
+
+def _single_rank(grade):
+    m = FONT_RE.match(grade)
+    if m is not None:
+        return FONT_RANKS.get(m.group(1))
+    m = V_RE.match(grade)
+    if m is not None and m.group(1) in V_GRADES:
+        rank = grade_rank(V_GRADES[m.group(1)])
+        if m.group(2) == '+':
+            rank += V_MODIFIER
+        elif m.group(2) == '-':
+            rank -= V_MODIFIER
+        return rank
+    return None
+
+def grade_rank(grade):
+    """ Numeric rank of a Font (6A+, f7A) or V-scale (V5, V0-) grade, slash
+    grades (6A/6A+, V3/4) rank in the middle. None if it doesn't parse
+    """
+    if grade is None:
+        return None
+    grade = grade.strip().upper()
+    low, sep, high = grade.partition('/')
+    if not sep:
+        return _single_rank(grade)
+    low_rank = _single_rank(low.strip())
+    high = high.strip()
+    if low.startswith('V') and high.isdigit():
+        # V3/4
+        high = 'V' + high
+    high_rank = _single_rank(high)
+    if low_rank is None or high_rank is None:
+        return None
+    return (low_rank + high_rank) // 2
+
+def rank_label(rank):
+    """ Font grade of a rank, like 6A/6A+ for one in between two of them
+    """
+    i, rest = divmod(rank, STEP)
+    i = min(max(i, 0), len(FONT_GRADES) - 1)
+    if rest and i + 1 < len(FONT_GRADES):
+        return '%s/%s' % (FONT_GRADES[i], FONT_GRADES[i + 1])
+    return FONT_GRADES[i]
+
+def parse_rank(grade):
+    rank = grade_rank(grade)
+    if rank is None:
+        raise ValueError("unknown grade %s" % grade)
+    return rank
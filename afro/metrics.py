@@ -0,0 +1,165 @@
+
+""" Request instrumentation: per route latency histograms, SQL statement
+counts and time per request, slow request logging and a /metrics endpoint
+in the Prometheus text format. Only installed when METRICS is set in the
+config, otherwise nothing is hooked anywhere
+"""
+
+import bisect
+import contextvars
+import logging
+import time
+
+from quart import request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+DEFAULT_SLOW_REQUEST_TIME = 1.0
+MAX_LOGGED_STATEMENTS = 20
+
+# statistics of the request being handled, propagated to the database
+# worker threads by afro.db
+current_stats = contextvars.ContextVar('request_stats', default=None)
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.statements = []
+
+    def add(self, statement, duration):
+        self.queries += 1
+        self.sql_time += duration
+        if len(self.statements) < MAX_LOGGED_STATEMENTS:
+            self.statements.append((duration, statement))
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def label_value(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kwds):
+    return ','.join('%s="%s"' % (k, label_value(str(v)))
+                    for k, v in kwds.items())
+
+class Metrics:
+    """ Totals per (route, method), route being the URL rule so that IDs
+    don't make a new series each
+    """
+    def __init__(self, slow_request_time=DEFAULT_SLOW_REQUEST_TIME):
+        self.slow_request_time = slow_request_time
+        self.latency = {}
+        self.responses = {}
+        self.queries = {}
+        self.sql_time = {}
+        self.slow = {}
+
+    def observe(self, route, method, status, duration, stats):
+        key = (route, method)
+        h = self.latency.get(key)
+        if h is None:
+            h = self.latency[key] = Histogram()
+        h.observe(duration)
+        status_key = key + (status,)
+        self.responses[status_key] = self.responses.get(status_key, 0) + 1
+        self.queries[key] = self.queries.get(key, 0) + stats.queries
+        self.sql_time[key] = self.sql_time.get(key, 0.0) + stats.sql_time
+        if duration >= self.slow_request_time:
+            self.slow[key] = self.slow.get(key, 0) + 1
+            log.warning("slow request %s %s: %.3fs, %d statements in %.3fs%s",
+                method, route, duration, stats.queries, stats.sql_time,
+                ''.join('\n  %.3fs %s' % (t, ' '.join(s.split()))
+                        for t, s in stats.statements))
+
+    def render(self):
+        """ All the metrics in the Prometheus text exposition format
+        """
+        out = []
+        out.append('# HELP afro_request_duration_seconds Request latency')
+        out.append('# TYPE afro_request_duration_seconds histogram')
+        for (route, method), h in sorted(self.latency.items()):
+            total = 0
+            les = ['%g' % b for b in h.buckets] + ['+Inf']
+            for le, n in zip(les, h.counts):
+                total += n
+                out.append('afro_request_duration_seconds_bucket{%s} %d' % (
+                    labels(route=route, method=method, le=le), total))
+            l = labels(route=route, method=method)
+            out.append('afro_request_duration_seconds_sum{%s} %r' % (l, h.sum))
+            out.append('afro_request_duration_seconds_count{%s} %d' % (
+                l, h.count))
+        out.append('# HELP afro_responses_total Responses by status code')
+        out.append('# TYPE afro_responses_total counter')
+        for (route, method, status), n in sorted(self.responses.items()):
+            out.append('afro_responses_total{%s} %d' % (
+                labels(route=route, method=method, status=status), n))
+        for name, help, values, fmt in [
+                ('afro_sql_statements_total', 'SQL statements executed',
+                 self.queries, '%d'),
+                ('afro_sql_seconds_total', 'Time spent executing SQL',
+                 self.sql_time, '%r'),
+                ('afro_slow_requests_total', 'Requests slower than %gs' %
+                 self.slow_request_time, self.slow, '%d')]:
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s counter' % name)
+            for (route, method), n in sorted(values.items()):
+                out.append(('%s{%s} ' + fmt) % (
+                    name, labels(route=route, method=method), n))
+        return '\n'.join(out) + '\n'
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_stats.get() is not None:
+        context._afro_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    stats = current_stats.get()
+    start = getattr(context, '_afro_start', None)
+    if stats is not None and start is not None:
+        stats.add(statement, time.perf_counter() - start)
+
+def register_metrics(app, state):
+    """ Instrument the app and its engine if METRICS is set, adds /metrics
+    """
+    if not app.config.get('METRICS'):
+        return None
+    metrics = state.metrics = Metrics(slow_request_time=app.config.get(
+        'SLOW_REQUEST_TIME', DEFAULT_SLOW_REQUEST_TIME))
+    event.listen(state.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(state.engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    async def start_request():
+        current_stats.set(RequestStats())
+
+    @app.after_request
+    async def finish_request(response):
+        stats = current_stats.get()
+        if stats is not None:
+            rule = request.url_rule
+            metrics.observe(rule.rule if rule is not None else 'unmatched',
+                request.method, response.status_code,
+                time.perf_counter() - stats.start, stats)
+        return response
+
+    @app.route('/metrics')
+    async def metrics_get():
+        return metrics.render(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    return metrics
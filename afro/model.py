@@ -1,8 +1,11 @@
 
 from sqlalchemy import (Table, Column, Integer, Boolean,
-    String, MetaData, ForeignKey, create_engine, Float)
+    String, MetaData, ForeignKey, create_engine, Float, LargeBinary, DDL,
+    event, Index)
 
 meta = MetaData()
+# tables created by hand with DDL below, so create_all does not touch them
+virtual_meta = MetaData()
 
 area = Table('area', meta,
     Column('id', Integer, primary_key=True, autoincrement=True),
@@ -14,7 +17,7 @@ area = Table('area', meta,
 
 sector = Table('sector', meta,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('area', Integer, ForeignKey('area.id')),
+    Column('area', Integer, ForeignKey('area.id'), index=True),
     Column('name', String),
     Column('description', String),
     Column('lat', Float),
@@ -23,7 +26,7 @@ sector = Table('sector', meta,
 
 block = Table('block', meta,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('sector', Integer, ForeignKey('sector.id')),
+    Column('sector', Integer, ForeignKey('sector.id'), index=True),
     Column('name', String),
     Column('description', String),
     Column('lat', Float),
@@ -35,8 +38,13 @@ problem = Table('problem', meta,
     Column('block', Integer, ForeignKey('block.id')),
     Column('name', String),
     Column('description', String),
-    Column('grade', String)
+    Column('grade', String),
+    # afro.grades.grade_rank of grade, set by whoever writes the row
+    Column('grade_rank', Integer)
 )
+# block lookups and grade ranges and histograms per block only touch these
+Index('ix_problem_block_grade_rank', problem.c.block, problem.c.grade_rank)
+Index('ix_problem_grade_rank', problem.c.grade_rank)
 
 photo = Table('photo', meta,
     Column('filename', String, primary_key=True)
@@ -44,28 +52,196 @@ photo = Table('photo', meta,
 
 photo_problem = Table('photo_problem', meta,
     Column('photo', String, ForeignKey('photo.filename')),
-    Column('problem', Integer, ForeignKey('problem.id'))
+    Column('problem', Integer, ForeignKey('problem.id'), index=True)
 )
 
 photo_block = Table('photo_block', meta,
     Column('photo', String, ForeignKey('photo.filename')),
-    Column('block', Integer, ForeignKey('block.id'))
+    Column('block', Integer, ForeignKey('block.id'), index=True)
 )
 
 line = Table('line', meta,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('photo', String, ForeignKey('photo.filename')),
-    Column('problem', Integer, ForeignKey('problem.id'))
+    Column('photo', String, ForeignKey('photo.filename'), index=True),
+    Column('problem', Integer, ForeignKey('problem.id')),
+    # x, y pairs packed with afro.geometry.pack_points
+    Column('points', LargeBinary),
+    # float32 Douglas-Peucker tolerance of each point, see
+    # afro.geometry.line_importance
+    Column('importance', LargeBinary)
 )
 
-point = Table('point', meta,
-    Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('line_id', Integer, ForeignKey('line.id')),
-    Column('x', Float),
-    Column('y', Float),
-    Column('index', Integer)
+# per zoom level grid of block counts for drawing clusters on a map,
+# maintained by afro.clusters
+block_cluster = Table('block_cluster', meta,
+    Column('zoom', Integer, primary_key=True, autoincrement=False),
+    Column('x', Integer, primary_key=True, autoincrement=False),
+    Column('y', Integer, primary_key=True, autoincrement=False),
+    Column('count', Integer),
+    Column('sum_lat', Float),
+    Column('sum_lon', Float),
+    # problems with a grade rank, the sum of their ranks and of its squares
+    Column('graded', Integer),
+    Column('sum_rank', Integer),
+    Column('sum_rank2', Integer)
+)
+
+def spatial_index(table):
+    """ Define a SQLite R*Tree over lat/lon of table, kept in sync with
+    triggers, so bounding box lookups don't need to scan the table
+    """
+    name = table.name
+    rtree = Table(name + '_rtree', virtual_meta,
+        Column('id', Integer, primary_key=True),
+        Column('minlat', Float),
+        Column('maxlat', Float),
+        Column('minlon', Float),
+        Column('maxlon', Float)
+    )
+    insert = ("INSERT INTO {0}_rtree SELECT new.id, new.lat, new.lat, "
+              "new.lon, new.lon WHERE new.lat IS NOT NULL AND "
+              "new.lon IS NOT NULL;").format(name)
+    for stmt in [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0}_rtree USING rtree("
+            "id, minlat, maxlat, minlon, maxlon)",
+        "CREATE TRIGGER IF NOT EXISTS {0}_rtree_insert AFTER INSERT ON {0} "
+            "BEGIN %s END" % insert,
+        "CREATE TRIGGER IF NOT EXISTS {0}_rtree_update AFTER UPDATE OF "
+            "lat, lon ON {0} BEGIN DELETE FROM {0}_rtree WHERE id = old.id; "
+            "%s END" % insert,
+        "CREATE TRIGGER IF NOT EXISTS {0}_rtree_delete AFTER DELETE ON {0} "
+            "BEGIN DELETE FROM {0}_rtree WHERE id = old.id; END",
+        ]:
+        event.listen(meta, 'after_create',
+                     DDL(stmt.format(name)).execute_if(dialect='sqlite'))
+    return rtree
+
+area_rtree = spatial_index(area)
+sector_rtree = spatial_index(sector)
+block_rtree = spatial_index(block)
+
+# full text index over names and descriptions, rowid is id * 4 + kind code
+SEARCH_KINDS = ['area', 'sector', 'block', 'problem']
+
+event.listen(meta, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "name, description, tokenize = 'unicode61 remove_diacritics 2')"
+    ).execute_if(dialect='sqlite'))
+
+def search_index(table):
+    """ Keep the names and descriptions of table in search_index
+    """
+    rowid = "{0}.id * %d + %d" % (len(SEARCH_KINDS),
+                                  SEARCH_KINDS.index(table.name))
+    for stmt in [
+        "CREATE TRIGGER IF NOT EXISTS {0}_search_insert AFTER INSERT ON {0} "
+            "BEGIN INSERT INTO search_index (rowid, name, description) "
+            "VALUES (%s, new.name, new.description); END" %
+            rowid.format('new'),
+        "CREATE TRIGGER IF NOT EXISTS {0}_search_update AFTER UPDATE OF "
+            "name, description ON {0} BEGIN UPDATE search_index SET "
+            "name = new.name, description = new.description "
+            "WHERE rowid = %s; END" % rowid.format('new'),
+        "CREATE TRIGGER IF NOT EXISTS {0}_search_delete AFTER DELETE ON {0} "
+            "BEGIN DELETE FROM search_index WHERE rowid = %s; END" %
+            rowid.format('old'),
+        ]:
+        event.listen(meta, 'after_create',
+                     DDL(stmt.format(table.name)).execute_if(dialect='sqlite'))
+
+search_index(area)
+search_index(sector)
+search_index(block)
+search_index(problem)
+
+# every write to the tables below appends (kind, ref) here, rev being
+# a global revision number clients can sync from
+change_log = Table('change_log', meta,
+    Column('rev', Integer, primary_key=True),
+    Column('kind', String),
+    Column('ref', Integer),
+    sqlite_autoincrement=True
+)
+
+def log_changes(table, kind, ref_column):
+    """ Log all inserts, updates and deletes of table in change_log as kind,
+    with ref_column of the row as ref
+    """
+    for event_name, row in [('INSERT', 'new'), ('UPDATE', 'new'),
+                            ('DELETE', 'old')]:
+        stmt = ("CREATE TRIGGER IF NOT EXISTS {0}_log_{1} AFTER {2} ON {0} "
+                "BEGIN INSERT INTO change_log (kind, ref) "
+                "VALUES ('{3}', {4}.{5}); END").format(
+            table.name, event_name.lower(), event_name, kind, row, ref_column)
+        event.listen(meta, 'after_create',
+                     DDL(stmt).execute_if(dialect='sqlite'))
+
+log_changes(area, 'area', 'id')
+log_changes(sector, 'sector', 'id')
+log_changes(block, 'block', 'id')
+log_changes(problem, 'problem', 'id')
+log_changes(line, 'line', 'id')
+log_changes(photo_block, 'block_photos', 'block')
+log_changes(photo_problem, 'problem_photos', 'problem')
+
+# per block problem and photo counts and grade histogram, kept up to date
+# by the triggers below so summaries of whole areas don't count rows. The
+# histogram is by problem.grade_rank, so 6a, 6A and f6A count together
+block_stats = Table('block_stats', meta,
+    Column('block', Integer, primary_key=True, autoincrement=False),
+    Column('problems', Integer, nullable=False),
+    Column('photos', Integer, nullable=False)
 )
 
+block_grade = Table('block_grade', meta,
+    Column('block', Integer, primary_key=True, autoincrement=False),
+    Column('grade_rank', Integer, primary_key=True, autoincrement=False),
+    Column('count', Integer, nullable=False)
+)
+
+def count_stmts(row, sign):
+    """ Statements adding the problem row ('new' or 'old') to the block
+    aggregates with sign 1, or removing it with -1
+    """
+    if sign > 0:
+        return (
+            "INSERT INTO block_stats (block, problems, photos) "
+            "VALUES ({0}.block, 1, 0) ON CONFLICT (block) DO UPDATE "
+            "SET problems = problems + 1; "
+            "INSERT INTO block_grade (block, grade_rank, count) "
+            "SELECT {0}.block, {0}.grade_rank, 1 "
+            "WHERE {0}.grade_rank IS NOT NULL "
+            "ON CONFLICT (block, grade_rank) DO UPDATE SET count = count + 1; "
+            ).format(row)
+    return (
+        "UPDATE block_stats SET problems = problems - 1 "
+        "WHERE block = {0}.block; "
+        "UPDATE block_grade SET count = count - 1 "
+        "WHERE block = {0}.block AND grade_rank = {0}.grade_rank; "
+        "DELETE FROM block_grade WHERE block = {0}.block AND "
+        "grade_rank = {0}.grade_rank AND count <= 0; ").format(row)
+
+for stmt in [
+    "CREATE TRIGGER IF NOT EXISTS problem_stats_insert AFTER INSERT ON "
+        "problem BEGIN %s END" % count_stmts('new', 1),
+    "CREATE TRIGGER IF NOT EXISTS problem_stats_update AFTER UPDATE OF "
+        "block, grade_rank ON problem BEGIN %s%s END" % (
+        count_stmts('old', -1), count_stmts('new', 1)),
+    "CREATE TRIGGER IF NOT EXISTS problem_stats_delete AFTER DELETE ON "
+        "problem BEGIN %s END" % count_stmts('old', -1),
+    "CREATE TRIGGER IF NOT EXISTS photo_block_stats_insert AFTER INSERT ON "
+        "photo_block BEGIN INSERT INTO block_stats (block, problems, photos) "
+        "VALUES (new.block, 0, 1) ON CONFLICT (block) DO UPDATE "
+        "SET photos = photos + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS photo_block_stats_delete AFTER DELETE ON "
+        "photo_block BEGIN UPDATE block_stats SET photos = photos - 1 "
+        "WHERE block = old.block; END",
+    "CREATE TRIGGER IF NOT EXISTS block_stats_delete AFTER DELETE ON block "
+        "BEGIN DELETE FROM block_stats WHERE block = old.id; "
+        "DELETE FROM block_grade WHERE block = old.id; END",
+    ]:
+    event.listen(meta, 'after_create', DDL(stmt).execute_if(dialect='sqlite'))
+
 # describe a line on the photo linked to a specific problem
 #polyline = Table('polyline')
 
@@ -0,0 +1,108 @@
+
+""" Small query language for the list endpoints. A query is a whitespace
+separated list of key:value terms, all of which have to match, e.g.
+
+    sector:3 grade:6A..7A name:~arete
+
+Values with spaces can be quoted, name:"big arete". Which keys are allowed
+depends on the endpoint, see doc/api.rst
+"""
+
+import shlex
+from functools import lru_cache
+
+from sqlalchemy import select, and_, exists
+
+from afro.grades import parse_rank
+from afro.spatial import parse_bbox, parse_near, radius_bbox, bbox_clause
+
+@lru_cache(maxsize=1024)
+def parse(query):
+    """ Split query into a tuple of (key, value) terms, raises ValueError
+    """
+    terms = []
+    for token in shlex.split(query):
+        key, sep, value = token.partition(':')
+        if not sep or not key:
+            raise ValueError("term %s is not key:value" % token)
+        terms.append((key, value))
+    if not terms:
+        raise ValueError("empty query")
+    return tuple(terms)
+
+def id_filter(column):
+    def compile_term(value):
+        return column == int(value)
+    return compile_term
+
+def text_filter(column):
+    """ key:value matches exactly, key:~value is a case insensitive
+    substring match
+    """
+    def compile_term(value):
+        if value.startswith('~'):
+            pattern = value[1:].replace('\\', '\\\\').replace(
+                '%', '\\%').replace('_', '\\_')
+            return column.ilike('%' + pattern + '%', escape='\\')
+        return column == value
+    return compile_term
+
+def grade_filter(rank_column):
+    """ key:a..b matches grades between a and b inclusive, either end can
+    be left out, key:a matches exactly. Grades are compared by their rank
+    (see afro.grades), so grade:6A..V5 works and is answered by an index on
+    the rank column. Unknown grades are a ValueError
+    """
+    def compile_term(value):
+        low, sep, high = value.partition('..')
+        if not sep:
+            return rank_column == parse_rank(value)
+        if not low and not high:
+            raise ValueError("empty range")
+        clauses = []
+        if low:
+            clauses.append(rank_column >= parse_rank(low))
+        if high:
+            clauses.append(rank_column <= parse_rank(high))
+        return and_(*clauses)
+    return compile_term
+
+def child_filter(child_column, parent_column, compile_child):
+    """ Match parents with at least one child row for which compile_child
+    matches
+    """
+    def compile_term(value):
+        return exists().where(and_(child_column == parent_column,
+                                   compile_child(value)))
+    return compile_term
+
+def compile_query(query, table, rtree, columns, filters):
+    """ Compile query into a single select of columns from table, using the
+    rtree for bbox: and near: terms. filters maps the other allowed keys to
+    functions making a where clause out of the value. Returns the statement
+    and the (lat, lon, radius, limit) of a near: term or None, the caller
+    is responsible for ranking the rows by distance. Raises ValueError for
+    invalid queries
+    """
+    clauses = []
+    near = None
+    bboxes = []
+    for key, value in parse(query):
+        if key == 'bbox' and rtree is not None:
+            bboxes.append(parse_bbox(value))
+        elif key == 'near' and rtree is not None:
+            if near is not None:
+                raise ValueError("only one near term allowed")
+            near = parse_near(value)
+            bboxes.append(radius_bbox(*near[:3]))
+        elif key in filters:
+            clauses.append(filters[key](value))
+        else:
+            raise ValueError("unsupported key %s" % key)
+    from_obj = table
+    if bboxes:
+        from_obj = table.join(rtree, rtree.c.id == table.c.id)
+        for bbox in bboxes:
+            clauses.append(bbox_clause(table, rtree, *bbox))
+    q = select(columns).select_from(from_obj).where(and_(*clauses))
+    return q, near
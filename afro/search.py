@@ -0,0 +1,32 @@
+
+import re
+
+from sqlalchemy import text
+
+from afro.model import SEARCH_KINDS
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+SEARCH = text(
+    "SELECT rowid, name, description FROM search_index "
+    "WHERE search_index MATCH :match ORDER BY rank LIMIT :limit")
+
+def match_expression(query):
+    """ FTS5 query matching entries with words starting with all the words
+    of query, so results show up while typing. None if there are no words
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % w for w in words)
+
+def search_result(row):
+    rowid, name, description = row
+    kind = SEARCH_KINDS[rowid % len(SEARCH_KINDS)]
+    return {
+        'type': kind,
+        'id': rowid // len(SEARCH_KINDS),
+        'name': name,
+        'description': description
+    }
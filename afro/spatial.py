@@ -0,0 +1,73 @@
+
+import math
+
+from sqlalchemy import and_
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# everything within the radius is ranked in Python, keep it to a region
+MAX_NEAR_RADIUS = 100 * 1000
+MAX_NEAR_LIMIT = 200
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Great circle distance in meters
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def radius_bbox(lat, lon, radius):
+    """ Bounding box (minlat, minlon, maxlat, maxlon) containing all the
+    points within radius meters of lat, lon
+    """
+    dlat = radius / METERS_PER_DEGREE
+    coslat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+    if coslat < 1e-9:
+        dlon = 180.0
+    else:
+        dlon = min(180.0, dlat / coslat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+def parse_bbox(s):
+    items = [float(x) for x in s.split(',')]
+    if len(items) != 4:
+        raise ValueError("bbox needs minlat,minlon,maxlat,maxlon")
+    return items
+
+def parse_near(s):
+    items = s.split(',')
+    if len(items) != 4:
+        raise ValueError("near needs lat,lon,radius_m,limit")
+    lat, lon, radius, limit = (float(items[0]), float(items[1]),
+                               float(items[2]), int(items[3]))
+    if not 0 < radius <= MAX_NEAR_RADIUS:
+        raise ValueError("near radius must be above 0 and at most %d" %
+                         MAX_NEAR_RADIUS)
+    if not 1 <= limit <= MAX_NEAR_LIMIT:
+        raise ValueError("near limit must be between 1 and %d" %
+                         MAX_NEAR_LIMIT)
+    return lat, lon, radius, limit
+
+def bbox_clause(table, rtree, minlat, minlon, maxlat, maxlon):
+    """ Where clause selecting the rows of table inside the bounding box,
+    to be used together with a join of table and its rtree
+    """
+    # the R*Tree stores float32 rounded outwards, the lookup is precise
+    # enough to prune and the exact check on table is cheap
+    return and_(rtree.c.maxlat >= minlat, rtree.c.minlat <= maxlat,
+                rtree.c.maxlon >= minlon, rtree.c.minlon <= maxlon,
+                table.c.lat.between(minlat, maxlat),
+                table.c.lon.between(minlon, maxlon))
+
+def nearest(rows, lat, lon, radius, limit):
+    """ Take (row, row_lat, row_lon) tuples, return up to limit of
+    (distance, row) within radius, closest first
+    """
+    r = []
+    for row, row_lat, row_lon in rows:
+        d = distance(lat, lon, row_lat, row_lon)
+        if d <= radius:
+            r.append((d, row))
+    r.sort(key=lambda x: x[0])
+    return r[:limit]
@@ -0,0 +1,56 @@
+
+""" Statements of the hot path routes, built once at import time with bound
+parameters. Run through Database.execute_prepared they are also compiled
+only once per process and, the SQL being the same every time, SQLite reuses
+its prepared statements too
+"""
+
+from sqlalchemy import select, bindparam, func
+
+from afro.model import (area, sector, block, problem, photo, photo_problem,
+                        photo_block, line)
+
+AREA_EXISTS = select([area.c.id]).where(area.c.id == bindparam('id'))
+SECTOR_EXISTS = select([sector.c.id]).where(sector.c.id == bindparam('id'))
+
+# grade histograms, counted off the problem (block, grade_rank) index
+def grades_by_rank(blocks):
+    return select([problem.c.grade_rank, func.count()]).select_from(
+        problem.join(block, block.c.id == problem.c.block)).where(
+        blocks).group_by(problem.c.grade_rank).order_by(problem.c.grade_rank)
+
+SECTOR_GRADES = grades_by_rank(block.c.sector == bindparam('sector'))
+AREA_GRADES = grades_by_rank(block.c.sector.in_(
+    select([sector.c.id]).where(sector.c.area == bindparam('area'))))
+
+BLOCK_GET = select([block.c.sector, block.c.name, block.c.lat, block.c.lon,
+                    block.c.description]).where(block.c.id == bindparam('id'))
+BLOCK_EXISTS = select([block.c.id]).where(block.c.id == bindparam('id'))
+BLOCK_PROBLEMS = select([problem.c.id, problem.c.name, problem.c.grade]).where(
+    problem.c.block == bindparam('block'))
+BLOCK_PROBLEM_IDS = select([problem.c.id]).where(
+    problem.c.block == bindparam('block'))
+BLOCK_PHOTOS = select([photo_block.c.photo]).where(
+    photo_block.c.block == bindparam('block'))
+
+PROBLEM_GET = select([problem.c.block, problem.c.name, problem.c.description,
+                      problem.c.grade]).where(problem.c.id == bindparam('id'))
+PROBLEM_EXISTS = select([problem.c.id]).where(problem.c.id == bindparam('id'))
+PROBLEM_PHOTOS = select([photo_problem.c.photo]).where(
+    photo_problem.c.problem == bindparam('problem'))
+PROBLEM_INSERT = problem.insert()
+
+PHOTO_EXISTS = select([photo.c.filename]).where(
+    photo.c.filename == bindparam('filename'))
+# lines of the photos, photos without lines have a single row of NULLs
+PHOTO_LINES = select([photo.c.filename, line.c.id, line.c.problem,
+                      line.c.points, line.c.importance]).select_from(
+    photo.outerjoin(line, line.c.photo == photo.c.filename)).where(
+    photo.c.filename.in_(bindparam('filenames', expanding=True))).order_by(
+    photo.c.filename, line.c.id)
+PHOTO_PROBLEM_INSERT = photo_problem.insert()
+PHOTO_BLOCK_INSERT = photo_block.insert()
+
+LINE_GET = select([line.c.points, line.c.importance]).where(
+    line.c.id == bindparam('id'))
+LINE_INSERT = line.insert()
@@ -0,0 +1,100 @@
+
+""" Delta sync for offline copies. Every write appends (kind, ref) to the
+change_log table, its autoincrement rev being the global revision. A client
+passes the last revision it has seen and gets the current state of every
+entity changed since, entities which no longer exist are reported as
+deleted
+"""
+
+from sqlalchemy import select, func
+
+from afro.geometry import unpack_points
+from afro.model import (area, sector, block, problem, line, photo_block,
+                        photo_problem, change_log)
+
+MAX_CHANGES = 1000
+
+LOCATION_FIELDS = ['name', 'description', 'lat', 'lon']
+
+# kind -> (table, fields returned for it)
+ENTITIES = {
+    'area': (area, ['id'] + LOCATION_FIELDS),
+    'sector': (sector, ['id', 'area'] + LOCATION_FIELDS),
+    'block': (block, ['id', 'sector'] + LOCATION_FIELDS),
+    'problem': (problem, ['id', 'block', 'name', 'description', 'grade']),
+    'line': (line, ['id', 'photo', 'problem', 'points']),
+}
+
+# kind -> (association table, entity column, parent table)
+ASSOCIATIONS = {
+    'block_photos': (photo_block, 'block', block),
+    'problem_photos': (photo_problem, 'problem', problem),
+}
+
+KINDS = list(ENTITIES) + list(ASSOCIATIONS)
+
+def current_rev(con):
+    return con.execute(select([func.max(change_log.c.rev)])).scalar() or 0
+
+def sync_window(con, since, max_changes=MAX_CHANGES):
+    """ Revision up to which changes after since are returned, at most
+    max_changes log entries. Returns (until, current revision)
+    """
+    rev = current_rev(con)
+    until = con.execute(select([change_log.c.rev]).where(
+        change_log.c.rev > since).order_by(change_log.c.rev).limit(1).offset(
+        max_changes - 1)).scalar()
+    return until or rev, rev
+
+def entity_rows(con, kind, ids):
+    table, fields = ENTITIES[kind]
+    q = con.execute(select([table.c[name] for name in fields]).where(
+        table.c.id.in_(ids)))
+    r = []
+    for row in q:
+        row = dict(zip(fields, row))
+        if kind == 'line':
+            row['points'] = unpack_points(row['points'])
+        r.append(row)
+    return r
+
+def association_rows(con, kind, ids):
+    table, column, parent = ASSOCIATIONS[kind]
+    existing = {x[0] for x in con.execute(select([parent.c.id]).where(
+        parent.c.id.in_(ids)))}
+    photos = {i: [] for i in existing}
+    for photo, ref in con.execute(select([table.c.photo, table.c[column]]).where(
+            table.c[column].in_(existing))):
+        photos[ref].append(photo)
+    return [{'id': i, 'photos': photos[i]} for i in sorted(existing)]
+
+def sync_changes(con, since, max_changes=MAX_CHANGES):
+    """ Changes after revision since, meant to be run within a transaction
+    so the revision matches the returned state. Raises ValueError if since
+    is from the future
+    """
+    until, rev = sync_window(con, since, max_changes)
+    if since > rev:
+        raise ValueError("revision %d is newer than the current %d" % (
+            since, rev))
+    refs = {kind: set() for kind in KINDS}
+    for kind, ref in con.execute(
+            select([change_log.c.kind, change_log.c.ref]).distinct().where(
+            change_log.c.rev > since).where(change_log.c.rev <= until)):
+        refs[kind].add(ref)
+    changed = {}
+    deleted = {}
+    for kind in KINDS:
+        ids = refs[kind]
+        if not ids:
+            continue
+        if kind in ENTITIES:
+            rows = entity_rows(con, kind, ids)
+        else:
+            rows = association_rows(con, kind, ids)
+        changed[kind] = rows
+        gone = ids - {row['id'] for row in rows}
+        if gone:
+            deleted[kind] = sorted(gone)
+    return {'rev': until, 'more': until < rev, 'changed': changed,
+            'deleted': deleted}
@@ -0,0 +1,80 @@
+
+""" Nested summary of an area: its sectors, their blocks and problems with
+problem and photo counts and grade histograms on every level. The per
+block numbers come from the block_stats and block_grade tables maintained by
+triggers, sectors and the area add those up, so the whole tree takes one
+query per level
+"""
+
+from sqlalchemy import select
+
+from afro.grades import rank_label
+from afro.model import (area, sector, block, problem, block_stats,
+                        block_grade)
+
+LOCATION_FIELDS = ['id', 'name', 'description', 'lat', 'lon']
+
+def new_node(row):
+    node = dict(zip(LOCATION_FIELDS, row))
+    node.update(problem_count=0, photo_count=0, grades={})
+    return node
+
+def add_counts(node, problems, photos, grades):
+    node['problem_count'] += problems
+    node['photo_count'] += photos
+    for grade, count in grades.items():
+        node['grades'][grade] = node['grades'].get(grade, 0) + count
+
+def area_tree(con, area_id, with_problems=True):
+    """ The tree of area_id or None if there is no such area. Run it within
+    a snapshot so the levels agree with each other
+    """
+    row = con.execute(select([area.c[name] for name in LOCATION_FIELDS])
+                      .where(area.c.id == area_id)).first()
+    if row is None:
+        return None
+    tree = new_node(row)
+    tree['sectors'] = []
+    sectors = {}
+    for row in con.execute(select([sector.c[name] for name in LOCATION_FIELDS])
+            .where(sector.c.area == area_id).order_by(sector.c.id)):
+        node = sectors[row[0]] = new_node(row)
+        node['blocks'] = []
+        tree['sectors'].append(node)
+
+    sector_ids = select([sector.c.id]).where(sector.c.area == area_id)
+    area_blocks = block.c.sector.in_(sector_ids)
+    blocks = {}
+    for row in con.execute(select([block.c[name] for name in LOCATION_FIELDS] +
+            [block.c.sector, block_stats.c.problems, block_stats.c.photos])
+            .select_from(block.outerjoin(block_stats,
+                                         block_stats.c.block == block.c.id))
+            .where(area_blocks).order_by(block.c.id)):
+        node = blocks[row[0]] = new_node(row[:len(LOCATION_FIELDS)])
+        node['sector'] = row.sector
+        node['problem_count'] = row.problems or 0
+        node['photo_count'] = row.photos or 0
+        if with_problems:
+            node['problems'] = []
+        sectors[row.sector]['blocks'].append(node)
+
+    for block_id, rank, count in con.execute(select([block_grade.c.block,
+            block_grade.c.grade_rank, block_grade.c.count]).select_from(
+            block_grade.join(block, block.c.id == block_grade.c.block))
+            .where(area_blocks)):
+        add_counts(blocks[block_id], 0, 0, {rank_label(rank): count})
+
+    for node in blocks.values():
+        for parent in (sectors[node.pop('sector')], tree):
+            add_counts(parent, node['problem_count'], node['photo_count'],
+                       node['grades'])
+
+    if with_problems:
+        for problem_id, block_id, name, grade in con.execute(select([
+                problem.c.id, problem.c.block, problem.c.name,
+                problem.c.grade]).select_from(
+                problem.join(block, block.c.id == problem.c.block))
+                .where(area_blocks).order_by(problem.c.id)):
+            blocks[block_id]['problems'].append(
+                {'id': problem_id, 'name': name, 'grade': grade})
+    return tree
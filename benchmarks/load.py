@@ -0,0 +1,333 @@
+
+""" python -m benchmarks.load [options]
+
+Load test of the API: fills a fresh database with a synthetic topo (areas,
+sectors, blocks, problems and photos with lines), then runs concurrent
+clients against the app through the Quart test client with a mix of map
+browsing, block details, photo fetches and annotation writes. Prints JSON
+with the throughput and latency percentiles per route, which can be saved
+with --output and compared against a previous run with --baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+import py
+from quart import Quart
+
+from afro.api import register_routes, State
+from afro.clusters import update_clusters
+from afro.db import get_db
+from afro.geometry import pack_line
+from afro.grades import grade_rank
+from afro.model import (meta, area, sector, block, problem, photo,
+                        photo_block, photo_problem, line)
+
+GRADES = ['4', '5', '5+', '6A', '6A+', '6B', '6B+', '6C', '6C+', '7A', '7A+',
+          '7B', '7B+', '7C', '7C+', '8A']
+WORDS = ['arete', 'roof', 'crack', 'slab', 'traverse', 'dyno', 'crimp',
+         'sloper', 'pocket', 'mantle', 'corner', 'overhang', 'egg', 'wave',
+         'big', 'little', 'red', 'green', 'moon', 'sun', 'river', 'forest']
+# meters to degrees, close enough for placing things
+DEGREE = 1 / 111000
+INSERT_BATCH = 1000
+# the raw photo route doesn't look inside, any bytes will do
+PHOTO_DATA = b'\xff\xd8\xff\xe0' + b'\x00' * 1020 + b'\xff\xd9'
+
+MIXES = {
+    'browse': ['block_list_bbox', 'block_list_grade', 'block_clusters',
+               'search'],
+    'detail': ['block_get', 'block_photos', 'problem_get'],
+    'photo': ['photo_get', 'photo_raw'],
+    'write': ['line_add', 'problem_add'],
+}
+DEFAULT_MIX = 'browse=4,detail=3,photo=2,write=1'
+
+def name(rng, words=2):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def random_line(rng):
+    n = rng.randint(5, 20)
+    x, y = rng.random(), rng.random()
+    points = []
+    for _ in range(n):
+        x = min(1.0, max(0.0, x + rng.uniform(-0.05, 0.05)))
+        y = min(1.0, max(0.0, y - rng.uniform(0, 0.05)))
+        points.append((round(x, 6), round(y, 6)))
+    return points
+
+def generate(con, args, photo_dir):
+    """ Insert the synthetic dataset, returns what the workload needs to
+    know about it: block positions, problem IDs and photo filenames
+    """
+    rng = random.Random(args.seed)
+    rows = {t: [] for t in (area, sector, block, problem, photo, photo_block,
+                            photo_problem, line)}
+    blocks = []
+    problems = []
+    ranks = []
+    photos = []
+    sectors_total = args.areas * args.sectors
+    blocks_per_sector = max(1, args.blocks // sectors_total)
+    for a in range(1, args.areas + 1):
+        alat, alon = rng.uniform(35, 60), rng.uniform(-10, 30)
+        rows[area].append(dict(id=a, name='area %d' % a, description=None,
+                               lat=alat, lon=alon))
+        for s in range(args.sectors):
+            sector_id = (a - 1) * args.sectors + s + 1
+            slat = alat + rng.gauss(0, 2000 * DEGREE)
+            slon = alon + rng.gauss(0, 2000 * DEGREE)
+            rows[sector].append(dict(id=sector_id, area=a, name=name(rng),
+                description=None, lat=slat, lon=slon))
+            for _ in range(blocks_per_sector):
+                block_id = len(blocks) + 1
+                lat = slat + rng.gauss(0, 200 * DEGREE)
+                lon = slon + rng.gauss(0, 200 * DEGREE)
+                blocks.append((block_id, lat, lon))
+                rows[block].append(dict(id=block_id, sector=sector_id,
+                    name=name(rng), description=name(rng, 8), lat=lat,
+                    lon=lon))
+                block_problems = []
+                ranks.append([])
+                for _ in range(rng.randint(1, 2 * args.problems - 1)):
+                    problem_id = len(problems) + 1
+                    grade = rng.choice(GRADES)
+                    ranks[-1].append(grade_rank(grade))
+                    problems.append(problem_id)
+                    block_problems.append(problem_id)
+                    rows[problem].append(dict(id=problem_id, block=block_id,
+                        name=name(rng, 3), description=name(rng, 12),
+                        grade=grade, grade_rank=grade_rank(grade)))
+                if rng.random() >= args.photos:
+                    continue
+                filename = 'photo%d.jpg' % len(photos)
+                photos.append(filename)
+                rows[photo].append(dict(filename=filename))
+                rows[photo_block].append(dict(photo=filename, block=block_id))
+                for problem_id in rng.sample(block_problems, min(
+                        len(block_problems), args.lines)):
+                    rows[photo_problem].append(dict(photo=filename,
+                                                    problem=problem_id))
+                    points, importance = pack_line(random_line(rng))
+                    rows[line].append(dict(id=len(rows[line]) + 1,
+                        photo=filename, problem=problem_id, points=points,
+                        importance=importance))
+    for table, table_rows in rows.items():
+        for i in range(0, len(table_rows), INSERT_BATCH):
+            con.execute(table.insert(), table_rows[i:i + INSERT_BATCH])
+    update_clusters(con, [(lat, lon) for _, lat, lon in blocks], 1, ranks)
+    for filename in photos:
+        with open(os.path.join(photo_dir, filename), 'wb') as f:
+            f.write(PHOTO_DATA)
+    return {'blocks': blocks, 'problems': problems, 'photos': photos}
+
+def make_requests(data, rng):
+    """ Request factories per route, each returning (method, path, json) """
+    blocks, problems, photos = data['blocks'], data['problems'], data['photos']
+
+    def around_block(size):
+        _, lat, lon = rng.choice(blocks)
+        return '%f,%f,%f,%f' % (lat - size, lon - size, lat + size, lon + size)
+
+    return {
+        'block_list_bbox': lambda: ('GET', '/block/list?q=bbox:%s' %
+                                    around_block(500 * DEGREE), None),
+        'block_list_grade': lambda: ('GET', '/block/list?q=' + quote(
+            'bbox:%s grade:%s..%s' % (around_block(2000 * DEGREE),
+            *sorted(rng.sample(GRADES, 2), key=GRADES.index))), None),
+        'block_clusters': lambda: ('GET', '/block/clusters?bbox=%s&zoom=%d' % (
+            around_block(0.2), rng.randint(8, 14)), None),
+        'search': lambda: ('GET', '/search?q=%s' % rng.choice(WORDS)[:4],
+                           None),
+        'block_get': lambda: ('GET', '/block/%d?details=1' %
+                              rng.choice(blocks)[0], None),
+        'block_photos': lambda: ('GET', '/block/%d/photos' %
+                                 rng.choice(blocks)[0], None),
+        'problem_get': lambda: ('GET', '/problem/%d' % rng.choice(problems),
+                                None),
+        'photo_get': lambda: ('GET', '/photo/%s' % rng.choice(photos), None),
+        'photo_raw': lambda: ('GET', '/photo/raw/%s' % rng.choice(photos),
+                              None),
+        'line_add': lambda: ('POST', '/line/add', {
+            'problem': rng.choice(problems),
+            'photo_filename': rng.choice(photos),
+            'point_list': random_line(rng)}),
+        'problem_add': lambda: ('POST', '/problem/add', {
+            'block': rng.choice(blocks)[0], 'name': name(rng, 3),
+            'grade': rng.choice(GRADES)}),
+    }
+
+def parse_mix(s):
+    weights = {}
+    for item in s.split(','):
+        group, _, weight = item.partition('=')
+        if group not in MIXES:
+            raise ValueError("unknown workload %s, pick from %s" % (
+                group, ', '.join(MIXES)))
+        for route in MIXES[group]:
+            weights[route] = float(weight or 1) / len(MIXES[group])
+    return weights
+
+def percentile(values, p):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+async def run_client(client, factories, routes, weights, rng, count, timings,
+                     errors):
+    for route in rng.choices(routes, weights, k=count):
+        method, path, body = factories[route]()
+        start = time.perf_counter()
+        if method == 'GET':
+            resp = await client.get(path)
+        else:
+            resp = await client.post(path, json=body)
+        await resp.get_data()
+        timings[route].append(time.perf_counter() - start)
+        if resp.status_code not in (200, 304):
+            errors[route] = errors.get(route, 0) + 1
+
+async def run_workload(app, data, args):
+    rng = random.Random(args.seed + 1)
+    factories = make_requests(data, rng)
+    weights = parse_mix(args.mix)
+    routes = list(weights)
+    timings = {route: [] for route in routes}
+    errors = {}
+    client = app.test_client()
+    per_client = [args.requests // args.clients] * args.clients
+    for i in range(args.requests % args.clients):
+        per_client[i] += 1
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(client, factories, routes, [weights[r] for r in routes],
+                   random.Random(rng.random()), n, timings, errors)
+        for n in per_client])
+    elapsed = time.perf_counter() - start
+    result = {}
+    for route, t in timings.items():
+        if not t:
+            continue
+        t.sort()
+        result[route] = {
+            'requests': len(t),
+            'errors': errors.get(route, 0),
+            'throughput': len(t) / elapsed,
+            'mean_ms': 1000 * sum(t) / len(t),
+            'p50_ms': 1000 * percentile(t, 50),
+            'p99_ms': 1000 * percentile(t, 99),
+        }
+    return elapsed, result
+
+def compare(result, baseline):
+    """ Relative change of p50, p99 and throughput against a previous run,
+    positive meaning slower
+    """
+    r = {}
+    for route, now in result['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if before is None:
+            continue
+        r[route] = {
+            'p50': now['p50_ms'] / before['p50_ms'] - 1,
+            'p99': now['p99_ms'] / before['p99_ms'] - 1,
+            'throughput': before['throughput'] / now['throughput'] - 1,
+        }
+    return r
+
+def make_app(database, photo_dir):
+    app = Quart("afro")
+    app.config['DATABASE'] = database
+    app.config['tmpdir'] = py.path.local(photo_dir)
+    state = State()
+    get_db(app, state)
+    meta.create_all(state.engine)
+    register_routes(app, state)
+    return app, state
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(
+        description=__doc__.split('\n\n', 1)[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--areas', type=int, default=5)
+    p.add_argument('--sectors', type=int, default=20,
+                   help='sectors per area')
+    p.add_argument('--blocks', type=int, default=10000,
+                   help='total number of blocks')
+    p.add_argument('--problems', type=int, default=3,
+                   help='average number of problems per block')
+    p.add_argument('--photos', type=float, default=0.5,
+                   help='fraction of blocks with a photo')
+    p.add_argument('--lines', type=int, default=3,
+                   help='maximum number of lines on a photo')
+    p.add_argument('--clients', type=int, default=50,
+                   help='number of concurrent clients')
+    p.add_argument('--requests', type=int, default=5000,
+                   help='total number of requests')
+    p.add_argument('--mix', default=DEFAULT_MIX,
+                   help='relative weights of %s, default %s' % (
+                       ', '.join(MIXES), DEFAULT_MIX))
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--database',
+                   help='database URL, a temporary SQLite file by default')
+    p.add_argument('--output', help='write the JSON result to this file')
+    p.add_argument('--baseline',
+                   help='JSON result of an earlier run to compare against')
+    args = p.parse_args(argv)
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        p.error(str(e))
+    return args
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix='afro-bench-')
+    try:
+        database = args.database or 'sqlite:///' + os.path.join(
+            workdir, 'bench.db')
+        photo_dir = os.path.join(workdir, 'photos')
+        os.mkdir(photo_dir)
+        app, state = make_app(database, photo_dir)
+        start = time.perf_counter()
+        data = await state.db.transaction(generate, args, photo_dir)
+        setup = time.perf_counter() - start
+        async with app.test_app():
+            elapsed, routes = await run_workload(app, data, args)
+        state.db.close()
+    finally:
+        shutil.rmtree(workdir)
+    total = sum(r['requests'] for r in routes.values())
+    result = {
+        'config': {k: v for k, v in vars(args).items()
+                   if k not in ('output', 'baseline')},
+        'dataset': {'blocks': len(data['blocks']),
+                    'problems': len(data['problems']),
+                    'photos': len(data['photos']),
+                    'setup_seconds': setup},
+        'total': {'requests': total, 'seconds': elapsed,
+                  'throughput': total / elapsed},
+        'routes': routes,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['baseline'] = compare(result, json.load(f))
+    return result
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    result = asyncio.run(main(args))
+    out = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    print(out)
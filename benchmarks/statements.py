@@ -0,0 +1,102 @@
+
+""" python -m benchmarks.statements [--iterations N]
+
+Per query overhead of the hot path statements: building the select on every
+call and compiling it (how the routes used to do it), executing the prebuilt
+statement from afro.statements with the compiled cache, and plain sqlite3
+running the same SQL as the floor. Prints JSON with microseconds per call
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from sqlalchemy import select, event
+
+from afro.db import Database
+from afro.geometry import pack_points
+from afro.model import meta, block, problem, photo, line
+from afro import statements
+
+def fill(con):
+    con.execute(block.insert(), [dict(id=i, sector=1, name='block %d' % i,
+        lat=46.0, lon=7.0) for i in range(1, 101)])
+    con.execute(problem.insert(), [dict(id=i, block=i % 100 + 1,
+        name='problem %d' % i, grade='6A') for i in range(1, 301)])
+    con.execute(photo.insert(), [dict(filename='photo%d.jpg' % i)
+                                 for i in range(10)])
+    con.execute(line.insert(), [dict(id=i, photo='photo%d.jpg' % (i % 10),
+        problem=i, points=pack_points([(0.1, 0.2), (0.3, 0.4)]))
+        for i in range(1, 31)])
+
+# name -> (statement built per call, prebuilt statement, its parameters)
+CASES = {
+    'block_get': (
+        lambda: select([block.c.sector, block.c.name, block.c.lat,
+            block.c.lon, block.c.description]).where(block.c.id == 42),
+        statements.BLOCK_GET, dict(id=42)),
+    'block_problems': (
+        lambda: select([problem.c.id, problem.c.name, problem.c.grade]).where(
+            problem.c.block == 42),
+        statements.BLOCK_PROBLEMS, dict(block=42)),
+    'problem_get': (
+        lambda: select([problem.c.block, problem.c.name,
+            problem.c.description, problem.c.grade]).where(
+            problem.c.id == 42),
+        statements.PROBLEM_GET, dict(id=42)),
+    'photo_lines': (
+        lambda: select([photo.c.filename, line.c.id, line.c.problem,
+            line.c.points]).select_from(photo.outerjoin(
+            line, line.c.photo == photo.c.filename)).where(
+            photo.c.filename.in_(['photo3.jpg'])).order_by(
+            photo.c.filename, line.c.id),
+        statements.PHOTO_LINES, dict(filenames=['photo3.jpg'])),
+}
+
+def capture_sql(engine, con, stmt, params):
+    """ The SQL and parameters SQLAlchemy passes to sqlite3 for stmt """
+    captured = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', capture)
+    con.execute(stmt, params).fetchall()
+    event.remove(engine, 'before_cursor_execute', capture)
+    return captured[0]
+
+def timed(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def run(iterations):
+    db = Database('sqlite://')
+    meta.create_all(db.engine)
+    result = {}
+    with db.engine.connect() as con:
+        fill(con)
+        prepared = con.execution_options(compiled_cache=db.compiled_cache)
+        cursor = con.connection.cursor()
+        for name, (build, stmt, params) in CASES.items():
+            sql, sql_params = capture_sql(db.engine, prepared, stmt, params)
+            built = timed(lambda: con.execute(build()).fetchall(), iterations)
+            reused = timed(lambda: prepared.execute(stmt, params).fetchall(),
+                           iterations)
+            raw = timed(lambda: cursor.execute(sql, sql_params).fetchall(),
+                        iterations)
+            result[name] = {
+                'built_us': built,
+                'prepared_us': reused,
+                'sqlite3_us': raw,
+                'overhead_saved_us': built - reused,
+            }
+    db.close()
+    return result
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[1])
+    p.add_argument('--iterations', type=int, default=5000)
+    args = p.parse_args(sys.argv[1:])
+    print(json.dumps(run(args.iterations), indent=2, sort_keys=True))
@@ -1,14 +1,26 @@
 
-""" createdb.py [DB URL]
+""" createdb.py DB_URL [ARCHIVE...]
+
+Creates the database and imports the given area archives (as downloaded
+from /area/[id]/export) into it
 """
 
 import sys
 from sqlalchemy import create_engine
 
+from afro.archive import import_archive
 from afro.model import meta
 
 if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
     db_url = sys.argv[1]
     engine = create_engine(db_url)
     engine.connect()
     meta.create_all(engine)
+    for archive in sys.argv[2:]:
+        with engine.begin() as con, open(archive, 'rb') as f:
+            counts = import_archive(con, f)
+        print("%s: %s" % (archive, ', '.join('%d %s' % (v, k)
+                                             for k, v in counts.items())))
@@ -1,27 +1,108 @@
 
 """ Usage:
 
-main.py PORT DB_FILE
+main.py [options] PORT DB_FILE
+
+Runs the development server, or with --workers the app under hypercorn
+with that many worker processes. See main.py --help for the options
 """
+import argparse
+import json
+import os
 import sys
+
+import py
 from quart import Quart
 
+import afro
 from afro.api import register_routes, State
+from afro.db import DEFAULT_PRAGMAS
+
+# the config of hypercorn workers, which are separate processes
+CONFIG_ENV = 'AFRO_CONFIG'
+
+def create_app(config=None):
+    """ Create the app with config, taken from the environment when run by
+    the hypercorn workers
+    """
+    if config is None:
+        config = json.loads(os.environ[CONFIG_ENV])
+    app = Quart("afro")
+    app.config.update(config)
+    if 'PHOTO_DIR' in config:
+        app.config['tmpdir'] = py.path.local(config['PHOTO_DIR'])
+    register_routes(app, State())
+    return app
 
-app = Quart("afro")
+def parse_args(argv):
+    p = argparse.ArgumentParser(usage=__doc__.split('\n')[3])
+    p.add_argument('port', type=int)
+    p.add_argument('db_file')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--workers', type=int, default=0,
+                   help='run under hypercorn with that many processes, '
+                   'more than one turns off the response cache')
+    p.add_argument('--photo-dir',
+                   help='where photos are stored, next to DB_FILE by default')
+    p.add_argument('--pool-size', type=int,
+                   help='database connections per process')
+    p.add_argument('--metrics', action='store_true',
+                   help='enable instrumentation and /metrics')
+    sqlite = p.add_argument_group('SQLite', 'set on every connection')
+    sqlite.add_argument('--journal-mode', default=DEFAULT_PRAGMAS[
+        'journal_mode'], choices=['delete', 'truncate', 'persist', 'wal'])
+    sqlite.add_argument('--synchronous', default=DEFAULT_PRAGMAS[
+        'synchronous'], choices=['off', 'normal', 'full', 'extra'])
+    sqlite.add_argument('--mmap-size', type=int,
+        default=DEFAULT_PRAGMAS['mmap_size'], help='bytes')
+    sqlite.add_argument('--busy-timeout', type=int,
+        default=DEFAULT_PRAGMAS['busy_timeout'], help='milliseconds')
+    sqlite.add_argument('--cache-size', type=int,
+        default=DEFAULT_PRAGMAS['cache_size'],
+        help='pages, or KiB if negative')
+    return p.parse_args(argv)
 
-if len(sys.argv) != 3:
-    print(__doc__)
-    sys.exit(1)
+def make_config(args):
+    # relative to the afro package, as always
+    db_file = os.path.join(os.path.dirname(afro.__file__), args.db_file)
+    config = {
+        'DATABASE': 'sqlite:///' + db_file,
+        'PHOTO_DIR': os.path.abspath(args.photo_dir or os.path.join(
+            os.path.dirname(db_file), 'photos')),
+        'DATABASE_PRAGMAS': {
+            'journal_mode': args.journal_mode,
+            'synchronous': args.synchronous,
+            'mmap_size': args.mmap_size,
+            'busy_timeout': args.busy_timeout,
+            'cache_size': args.cache_size,
+        },
+    }
+    if args.pool_size is not None:
+        config['DATABASE_POOL_SIZE'] = args.pool_size
+    if args.metrics:
+        config['METRICS'] = True
+    if args.workers > 1:
+        # the response cache and its ETags are per process, a write in one
+        # worker would not invalidate the others
+        config['CACHE'] = False
+    return config
 
-port = int(sys.argv[1])
-db_file = sys.argv[2]
+def serve(config, args):
+    from hypercorn.config import Config
+    from hypercorn.run import run
 
-app.config.update({
-    'DATABASE': 'sqlite:///' + str(app.root_path / db_file),
-})
+    os.environ[CONFIG_ENV] = json.dumps(config)
+    hypercorn_config = Config()
+    hypercorn_config.bind = ['%s:%d' % (args.host, args.port)]
+    hypercorn_config.workers = args.workers
+    hypercorn_config.application_path = '%s:create_app()' % os.path.abspath(
+        __file__)
+    return run(hypercorn_config)
 
 if __name__ == '__main__':
-    state = State()
-    app = register_routes(app, state)
-    app.run(port=port)
+    args = parse_args(sys.argv[1:])
+    config = make_config(args)
+    os.makedirs(config['PHOTO_DIR'], exist_ok=True)
+    if args.workers:
+        sys.exit(serve(config, args))
+    create_app(config).run(host=args.host, port=args.port)
@@ -0,0 +1,134 @@
+
+""" migrate.py [DB URL]
+
+Upgrades a database created by an older version of createdb.py to the
+current schema
+"""
+
+import sys
+from sqlalchemy import create_engine, inspect, text, select, func
+
+from afro.clusters import update_clusters
+from afro.geometry import (pack_points, unpack_points, pack_floats,
+                           line_importance)
+from afro.grades import grade_rank
+from afro.model import (meta, line, area, sector, block, problem,
+                        block_cluster, SEARCH_KINDS)
+
+def migrate_points(con):
+    """ Move the one-row-per-vertex point table into packed line.points
+    """
+    columns = [c['name'] for c in inspect(con).get_columns('line')]
+    if 'points' not in columns:
+        con.execute(text("ALTER TABLE line ADD COLUMN points BLOB"))
+    if 'point' not in inspect(con).get_table_names():
+        return
+    points = {}
+    for line_id, x, y in con.execute(text(
+            "SELECT line_id, x, y FROM point ORDER BY line_id, \"index\"")):
+        points.setdefault(line_id, []).append((x, y))
+    for line_id, l in points.items():
+        con.execute(line.update().where(line.c.id == line_id).values(
+            points=pack_points(l)))
+    con.execute(text("DROP TABLE point"))
+
+def migrate_line_importance(con):
+    """ Work out the simplification levels of lines stored without them
+    """
+    columns = [c['name'] for c in inspect(con).get_columns('line')]
+    if 'importance' not in columns:
+        con.execute(text("ALTER TABLE line ADD COLUMN importance BLOB"))
+    for line_id, points in list(con.execute(select([line.c.id, line.c.points])
+            .where(line.c.importance.is_(None)))):
+        con.execute(line.update().where(line.c.id == line_id).values(
+            importance=pack_floats(line_importance(unpack_points(points)))))
+
+def migrate_grades(con):
+    """ Rank the grades of problems stored without a rank
+    """
+    columns = [c['name'] for c in inspect(con).get_columns('problem')]
+    if 'grade_rank' not in columns:
+        con.execute(text("ALTER TABLE problem ADD COLUMN grade_rank INTEGER"))
+    for problem_id, grade in list(con.execute(select([problem.c.id,
+            problem.c.grade]).where(problem.c.grade_rank.is_(None) &
+            problem.c.grade.isnot(None)))):
+        rank = grade_rank(grade)
+        if rank is not None:
+            con.execute(problem.update().where(problem.c.id == problem_id)
+                        .values(grade_rank=rank))
+
+def migrate_indexes(con):
+    """ create_all skips tables that exist, add the indexes they are missing
+    """
+    for table in meta.sorted_tables:
+        existing = {x['name'] for x in inspect(con).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(con)
+
+def migrate_spatial(con):
+    """ Fill the R*Tree indexes, the triggers only cover new writes
+    """
+    for table in (area, sector, block):
+        con.execute(text(
+            "INSERT INTO {0}_rtree SELECT id, lat, lat, lon, lon FROM {0} "
+            "WHERE lat IS NOT NULL AND lon IS NOT NULL AND id NOT IN "
+            "(SELECT id FROM {0}_rtree)".format(table.name)))
+
+def migrate_search(con):
+    for table in (area, sector, block, problem):
+        rowid = "id * %d + %d" % (len(SEARCH_KINDS),
+                                  SEARCH_KINDS.index(table.name))
+        con.execute(text(
+            "INSERT INTO search_index (rowid, name, description) "
+            "SELECT {0}, name, description FROM {1} WHERE {0} NOT IN "
+            "(SELECT rowid FROM search_index)".format(rowid, table.name)))
+
+def migrate_clusters(con):
+    """ Fill the clusters together with the grade ranks of their problems,
+    unless that was done already
+    """
+    if con.execute(select([func.count()]).select_from(block_cluster)).scalar():
+        return
+    ranks = {}
+    for block_id, rank in con.execute(select([problem.c.block,
+            problem.c.grade_rank]).where(problem.c.grade_rank.isnot(None))):
+        ranks.setdefault(block_id, []).append(rank)
+    blocks = list(con.execute(select([block.c.id, block.c.lat, block.c.lon])))
+    update_clusters(con, [(lat, lon) for _, lat, lon in blocks], 1,
+                    [ranks.get(block_id, ()) for block_id, _, _ in blocks])
+
+def migrate_block_stats(con):
+    """ Rebuild the block aggregates, the triggers only cover new writes and
+    the grade ranks set by migrate_grades went through them already
+    """
+    con.execute(text("DELETE FROM block_stats"))
+    con.execute(text("DELETE FROM block_grade"))
+    con.execute(text(
+        "INSERT INTO block_stats (block, problems, photos) "
+        "SELECT id, (SELECT count(*) FROM problem WHERE block = block.id), "
+        "(SELECT count(*) FROM photo_block WHERE block = block.id) "
+        "FROM block"))
+    con.execute(text(
+        "INSERT INTO block_grade (block, grade_rank, count) "
+        "SELECT block, grade_rank, count(*) FROM problem "
+        "WHERE grade_rank IS NOT NULL AND block IN (SELECT id FROM block) "
+        "GROUP BY block, grade_rank"))
+
+def migrate(engine):
+    with engine.begin() as con:
+        meta.create_all(con)
+        migrate_points(con)
+        migrate_line_importance(con)
+        migrate_grades(con)
+        migrate_indexes(con)
+        migrate_spatial(con)
+        migrate_clusters(con)
+        migrate_search(con)
+        migrate_block_stats(con)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    migrate(create_engine(sys.argv[1]))
@@ -1,23 +1,37 @@
 
-import pytest, json, py
+import pytest, json, py, asyncio, io, sqlite3
 from quart import Quart
+from sqlalchemy import select
 
-from afro.db import get_db
-from afro.model import meta
+from afro.db import get_db, Database, allocate_ids
+from afro.model import meta, area, sector, block
 from afro.api import register_routes, State
+from main import parse_args, make_config
 
 def init_db(state):
     meta.create_all(state.engine)
 
 @pytest.fixture
-def db():
+def app_state(request, tmpdir):
+    """ The app and its state. Tests can pass extra config with
+    @pytest.mark.parametrize('app_state', [config], indirect=True), {tmpdir}
+    in string values is replaced with the test's tmpdir
+    """
     app = Quart("afro")
     app.config['DATABASE'] = 'sqlite:///:memory:'
+    for key, value in getattr(request, 'param', {}).items():
+        if isinstance(value, str):
+            value = value.format(tmpdir=tmpdir)
+        app.config[key] = value
     state = State()
     get_db(app, state)
     init_db(state)
     register_routes(app, state)
-    return app
+    return app, state
+
+@pytest.fixture
+def db(app_state):
+    return app_state[0]
 
 class Error(Exception):
     pass
@@ -126,6 +140,17 @@ async def test_pictures(db, tmpdir):
     assert r['type'] == 'jpg'
     r = await client.get('/photo/raw/photo0.jpg')
     assert (await r.get_data()) == b'foobarbaz'
+    assert 'max-age' in r.headers['Cache-Control']
+    etag = r.headers['ETag']
+    r = await client.get('/photo/raw/photo0.jpg',
+                         headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    r = await client.get('/photo/raw/photo0.jpg',
+                         headers={'Range': 'bytes=3-5'})
+    assert r.status_code == 206
+    assert (await r.get_data()) == b'bar'
+    r = await client.get('/photo/raw/photo7.jpg')
+    assert r.status_code == 404
 
     await post(client, '/photo/associate', form={
         'photo_filename': 'photo0.jpg',
@@ -177,6 +202,24 @@ async def test_lines(db, tmpdir):
     assert r['lines'] == [{'id': 1, 'problem': problem_id,
        'points': [[0.1, 0.2], [0.3, 0.4]]}]
 
+    r = await post(client, '/photo/add', data=b"foobarbaz")
+    assert r['filename'] == 'photo1.jpg'
+    r = await post(client, '/line/add', form=dict(
+        photo_filename='photo0.jpg', problem=problem_id,
+        point_list="0.5,0.6,0.7,0.8,0.9,1.0"
+        ))
+    line2_id = r['id']
+    r = await get(client, '/photo/many?f=photo1.jpg,photo0.jpg')
+    assert r['photos'] == [
+        {'filename': 'photo1.jpg', 'type': 'jpg', 'lines': []},
+        {'filename': 'photo0.jpg', 'type': 'jpg', 'lines': [
+            {'id': line_id, 'problem': problem_id,
+             'points': [[0.1, 0.2], [0.3, 0.4]]},
+            {'id': line2_id, 'problem': problem_id,
+             'points': [[0.5, 0.6], [0.7, 0.8], [0.9, 1.0]]}]}]
+    resp = await client.get('/photo/many?f=photo0.jpg,photo7.jpg')
+    assert resp.status_code != 200
+
 @pytest.mark.asyncio
 async def test_boulder_list(db):
     client = db.test_client()
@@ -224,4 +267,924 @@ async def test_boulder_details(db):
             'name': 'foo bar',
             'grade': None
         }]
-    }
\ No newline at end of file
+    }
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('app_state', [{
+    'DATABASE': 'sqlite:///{tmpdir}/afro.db', 'DATABASE_POOL_SIZE': 2,
+    'DATABASE_MAX_OVERFLOW': 0}], indirect=True)
+async def test_concurrent_requests(app_state):
+    app, state = app_state
+    assert state.db.executor._max_workers == 2
+    client = app.test_client()
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    res = await asyncio.gather(*[get(client, '/block/%d' % block_id)
+                                 for i in range(20)])
+    assert all(r['name'] == 'foo' for r in res)
+    r = await post_json(client, '/batch', {'requests': [
+        '/block/%d' % block_id] * 20})
+    assert all(x['body']['name'] == 'foo' for x in r['responses'])
+
+async def post_json(client, url, data):
+    resp = await client.post(url, json=data)
+    r = json.loads((await resp.get_data()).decode('utf8'))
+    if resp.status_code != 200 or r['status'] != 'OK':
+        raise Error(r['status'])
+    return r
+
+@pytest.mark.asyncio
+async def test_bulk_add(db, tmpdir):
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    await post(client, '/photo/add', data=b"foobarbaz")
+
+    r = await post_json(client, '/bulk/add', {
+        'blocks': [
+            {'ref': 'b1', 'sector': 0, 'lat': 1.0, 'lon': 2.0, 'name': 'b1'},
+            {'ref': 'b2', 'sector': 0, 'lat': 1.5, 'lon': 2.5},
+        ],
+        'problems': [
+            {'ref': 'p1', 'block_ref': 'b2', 'name': 'p1', 'grade': '6A'},
+            {'block': block_id, 'name': 'p2'},
+        ],
+        'lines': [
+            {'problem_ref': 'p1', 'photo_filename': 'photo0.jpg',
+             'point_list': [0.1, 0.2, 0.3, 0.4]},
+        ]
+    })
+    b1, b2 = r['blocks']
+    p1, p2 = r['problems']
+    assert b1 == block_id + 1
+    r = await get(client, '/block/%d' % b2)
+    assert r['problems'] == [p1]
+    r = await get(client, '/block/%d' % block_id)
+    assert r['problems'] == [p2]
+    r = await get(client, '/photo/photo0.jpg')
+    assert r['lines'] == [{'id': 1, 'problem': p1,
+                           'points': [[0.1, 0.2], [0.3, 0.4]]}]
+
+    # a bad entry anywhere rolls back the whole batch
+    with pytest.raises(Error) as e:
+        await post_json(client, '/bulk/add', {
+            'blocks': [{'ref': 'b3', 'sector': 0, 'lat': 1.0, 'lon': 2.0}],
+            'problems': [{'block_ref': 'b3'}, {'block': 1234}],
+        })
+    assert 'unknown block id 1234' in e.value.args[0]
+    r = await get(client, '/block/list?q=sector:0')
+    assert len(r['blocks']) == 3
+    with pytest.raises(Error) as e:
+        await post_json(client, '/bulk/add', {
+            'lines': [{'problem': p1, 'photo_filename': 'photo0.jpg',
+                       'point_list': 'foo,bar'}]})
+    assert 'Not a float' in e.value.args[0]
+    for data, error in [
+            ({'blocks': [{'ref': ['b'], 'sector': 0, 'lat': 1, 'lon': 2}]},
+             "ref must be a string or an integer, not ['b']"),
+            ({'problems': [{'ref': True, 'block': b1}]},
+             'ref must be a string or an integer, not True'),
+            ({'problems': [{'block_ref': {'a': 1}}]},
+             "block_ref must be a string or an integer, not {'a': 1}"),
+            ({'lines': [{'problem_ref': [1], 'photo_filename': 'photo0.jpg',
+                         'point_list': [0.1, 0.2, 0.3, 0.4]}]},
+             'problem_ref must be a string or an integer, not [1]')]:
+        with pytest.raises(Error) as e:
+            await post_json(client, '/bulk/add', data)
+        assert error in e.value.args[0]
+
+@pytest.mark.asyncio
+async def test_photo_upload(db, tmpdir):
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    res = await asyncio.gather(*[post(client, '/photo/add', data=b"x" * i)
+                                 for i in range(5)])
+    filenames = sorted(r['filename'] for r in res)
+    assert filenames == ['photo%d.jpg' % i for i in range(5)]
+    for r in res:
+        size = tmpdir.join(r['filename']).size()
+        assert size == res.index(r)
+
+    # bigger than Quart's default MAX_CONTENT_LENGTH
+    r = await post(client, '/photo/add', data=b"x" * (17 * 1024 * 1024))
+    assert tmpdir.join(r['filename']).size() == 17 * 1024 * 1024
+    tmpdir.join(r['filename']).remove()
+    db.config['MAX_CONTENT_LENGTH'] = 5
+    resp = await client.post('/photo/add', data=b"foobarbaz")
+    assert resp.status_code == 413
+    r = json.loads((await resp.get_data()).decode('utf8'))
+    assert r['status'] == 'request too big, maximum size is 5 bytes'
+
+    db.config['MAX_CONTENT_LENGTH'] = None
+    db.config['MAX_PHOTO_SIZE'] = 5
+    resp = await client.post('/photo/add', data=b"foobarbaz")
+    assert resp.status_code == 413
+    assert sorted(x.basename for x in tmpdir.listdir() if x.isfile()) == \
+        filenames
+
+@pytest.mark.asyncio
+async def test_photo_derivatives(db, tmpdir):
+    Image = pytest.importorskip('PIL.Image')
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    data = io.BytesIO()
+    Image.new('RGB', (1000, 500), 'red').save(data, 'JPEG')
+    r = await post(client, '/photo/add', data=data.getvalue())
+    photo_file = r['filename']
+    await asyncio.gather(*db.background_tasks)
+    assert sorted(x.basename for x in tmpdir.join('derivatives').listdir()) \
+        == ['photo0-1280.jpg', 'photo0-1280.webp', 'photo0-320.jpg',
+            'photo0-320.webp', 'photo0-640.jpg', 'photo0-640.webp']
+
+    r = await client.get('/photo/raw/%s?w=320' % photo_file)
+    im = Image.open(io.BytesIO(await r.get_data()))
+    assert im.size == (320, 160)
+    r = await client.get('/photo/raw/%s?w=640&format=webp' % photo_file)
+    im = Image.open(io.BytesIO(await r.get_data()))
+    assert (im.format, im.size) == ('WEBP', (640, 320))
+    # never scaled up
+    r = await client.get('/photo/raw/%s?w=1280' % photo_file)
+    im = Image.open(io.BytesIO(await r.get_data()))
+    assert im.size == (1000, 500)
+    r = await client.get('/photo/raw/%s?w=100' % photo_file)
+    assert r.status_code != 200
+
+@pytest.mark.asyncio
+async def test_spatial_list(db):
+    client = db.test_client()
+
+    ids = []
+    for name, lat, lon in [('a', 46.0, 7.0), ('b', 46.001, 7.001),
+                           ('c', 46.1, 7.1), ('d', -10.0, 20.0)]:
+        r = await post(client, '/block/add', form={'sector': '0',
+            'name': name, 'lat': str(lat), 'lon': str(lon)})
+        ids.append(r['id'])
+
+    r = await get(client, '/block/list?q=bbox:45.5,6.5,46.05,7.05')
+    assert [x['name'] for x in r['blocks']] == ['a', 'b']
+    r = await get(client, '/block/list?q=near:46.0011,7.0011,500,10')
+    assert [x['name'] for x in r['blocks']] == ['b', 'a']
+    assert r['blocks'][0]['distance'] < 20
+    r = await get(client, '/block/list?q=near:46.0011,7.0011,50000,1')
+    assert [x['name'] for x in r['blocks']] == ['b']
+
+    await post(client, '/block/%d' % ids[2], form={'lat': '46.002'})
+    await post(client, '/block/delete', form={'id': ids[0]})
+    r = await get(client, '/block/list?q=bbox:45.5,6.5,46.05,7.05')
+    assert [x['name'] for x in r['blocks']] == ['b']
+    r = await get(client, '/block/list?q=bbox:45.5,6.5,46.05,7.5')
+    assert [x['name'] for x in r['blocks']] == ['b', 'c']
+
+    resp = await client.get('/block/list?q=bbox:1,2,3')
+    assert resp.status_code != 200
+
+    r = await get(client, '/sector/list?q=near:46.0,7.0,1000,10')
+    assert r['sectors'] == []
+    r = await get(client, '/area/list?q=bbox:-90,-180,90,180')
+    assert r['areas'] == []
+
+@pytest.mark.asyncio
+async def test_block_clusters(db):
+    client = db.test_client()
+
+    ids = []
+    for lat, lon in [(46.0, 7.0), (46.2, 7.2), (-10.0, 20.0)]:
+        r = await post(client, '/block/add', form={'sector': '0',
+            'lat': str(lat), 'lon': str(lon)})
+        ids.append(r['id'])
+    await post_json(client, '/bulk/add', {
+        'blocks': [{'ref': 'a', 'sector': 0, 'lat': 46.1, 'lon': 7.1}],
+        'problems': [{'block_ref': 'a', 'grade': '7A'}]})
+    for block_id, grade in [(ids[0], '6A'), (ids[1], 'V6'), (ids[1], 'hard')]:
+        await post(client, '/problem/add', form=dict(block=block_id,
+                                                     grade=grade))
+
+    r = await get(client, '/block/clusters?bbox=-90,-180,90,180&zoom=0')
+    assert len(r['clusters']) == 1
+    assert r['clusters'][0]['count'] == 4
+    r = await get(client, '/block/clusters?bbox=45,6,47,8&zoom=2')
+    assert len(r['clusters']) == 1
+    c = r['clusters'][0]
+    assert c['count'] == 3
+    assert abs(c['lat'] - 46.1) < 1e-9 and abs(c['lon'] - 7.1) < 1e-9
+    # ranks 50, 110 and 110
+    grades = c['grades']
+    assert (grades['count'], grades['mean']) == (3, 90.0)
+    assert abs(grades['stddev'] - 800 ** 0.5) < 1e-9
+    assert (grades['grade'], grades['low'], grades['high']) == (
+        '6C', '6A+/6B', '7A/7A+')
+    r = await get(client, '/block/clusters?bbox=45,6,47,8&zoom=18')
+    assert sorted(x['count'] for x in r['clusters']) == [1, 1, 1]
+
+    await post(client, '/block/%d' % ids[1], form={'lat': '-10.0',
+                                                   'lon': '20.0'})
+    await post(client, '/block/delete', form={'id': ids[0]})
+    r = await get(client, '/block/clusters?bbox=45,6,47,8&zoom=2')
+    assert [x['count'] for x in r['clusters']] == [1]
+    assert r['clusters'][0]['grades'] == {'count': 1, 'mean': 110.0,
+        'stddev': 0.0, 'grade': '7A', 'low': '7A', 'high': '7A'}
+    r = await get(client, '/block/clusters?bbox=-11,19,-9,21&zoom=10')
+    assert [(x['count'], x['lat'], x['lon'], x['grades']['count'])
+            for x in r['clusters']] == [(2, -10.0, 20.0, 1)]
+
+    resp = await client.get('/block/clusters?bbox=45,6,47,8')
+    assert resp.status_code != 200
+
+@pytest.mark.asyncio
+async def test_block_query(db):
+    client = db.test_client()
+
+    r = await post_json(client, '/bulk/add', {
+        'blocks': [
+            {'ref': 'a', 'sector': 3, 'lat': 46.0, 'lon': 7.0,
+             'name': 'Big Arete'},
+            {'ref': 'b', 'sector': 3, 'lat': 46.0, 'lon': 7.0,
+             'name': 'roof', 'description': '100% arete'},
+            {'ref': 'c', 'sector': 4, 'lat': 46.0, 'lon': 7.0,
+             'name': 'arete 2'},
+        ],
+        'problems': [
+            {'block_ref': 'a', 'grade': '6A'},
+            {'block_ref': 'a', 'grade': '7B'},
+            {'block_ref': 'b', 'grade': '6C+'},
+            {'block_ref': 'c', 'grade': '6B'},
+        ]})
+    a, b, c = r['blocks']
+
+    async def names(q):
+        r = await get(client, '/block/list?q=' + q)
+        return [x['name'] for x in r['blocks']]
+
+    assert await names('sector:3') == ['Big Arete', 'roof']
+    assert await names('name:~arete') == ['Big Arete', 'arete 2']
+    assert await names('sector:3 name:~arete') == ['Big Arete']
+    assert await names('name:"Big Arete"') == ['Big Arete']
+    assert await names('description:~100%') == ['roof']
+    assert await names('description:~100%25') == ['roof']
+    assert await names('grade:6B..7A') == ['roof', 'arete 2']
+    assert await names('grade:7A..') == ['Big Arete']
+    assert await names('sector:3 grade:..6B') == ['Big Arete']
+    assert await names('sector:3 grade:6C%2B') == ['roof']
+    assert await names('bbox:45,6,47,8 sector:4') == ['arete 2']
+
+    for q in ['foo:1', 'sector', 'sector:x', 'grade:..', '']:
+        resp = await client.get('/block/list?q=' + q)
+        assert resp.status_code != 200
+
+@pytest.mark.asyncio
+async def test_block_list_pages(db):
+    client = db.test_client()
+
+    r = await post_json(client, '/bulk/add', {'blocks': [
+        {'sector': 0, 'lat': 46.0, 'lon': 7.0, 'name': 'b%d' % i}
+        for i in range(5)]})
+    ids = r['blocks']
+
+    r = await get(client, '/block/list?q=sector:0&limit=2')
+    assert [x['id'] for x in r['blocks']] == ids[:2]
+    assert r['next'] == ids[1]
+    r = await get(client, '/block/list?q=sector:0&limit=2&after=%d' % r['next'])
+    assert [x['id'] for x in r['blocks']] == ids[2:4]
+    r = await get(client, '/block/list?q=sector:0&limit=2&after=%d' % r['next'])
+    assert [x['id'] for x in r['blocks']] == ids[4:]
+    assert r['next'] is None
+    r = await get(client, '/block/list?q=sector:0')
+    assert len(r['blocks']) == 5
+    assert r['next'] is None
+
+    resp = await client.get('/block/list?q=sector:0&after=%d&stream=1' %
+                            ids[0])
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'application/x-ndjson'
+    lines = (await resp.get_data()).decode('utf8').splitlines()
+    assert [json.loads(x)['id'] for x in lines] == ids[1:]
+
+    resp = await client.get('/block/list?q=sector:0&limit=3&stream=1')
+    lines = (await resp.get_data()).decode('utf8').splitlines()
+    assert [json.loads(x)['id'] for x in lines] == ids[:3]
+
+    for q in ['sector:0&limit=0', 'sector:0&after=x',
+              'near:46,7,100,10&limit=2', 'near:46,7,100,10&stream=1',
+              'near:46,7,100,-1', 'near:46,7,100,0', 'near:46,7,100,201',
+              'near:46,7,0,10', 'near:46,7,-5,10', 'near:46,7,1e9,10',
+              'near:46,7,nan,10']:
+        resp = await client.get('/block/list?q=' + q)
+        assert resp.status_code != 200
+
+@pytest.mark.asyncio
+async def test_stream_chunks(tmpdir):
+    # a single connection, which a stream must not hold between chunks
+    db = Database('sqlite:///' + str(tmpdir.join('afro.db')), pool_size=1,
+                  max_overflow=0, pool_timeout=0.1)
+    meta.create_all(db.engine)
+    await db.execute(block.insert(), [{'id': i, 'name': 'b%d' % i}
+                                      for i in range(1, 8)])
+
+    def make_stmt(after, limit):
+        q = select([block.c.id]).order_by(block.c.id).limit(limit)
+        if after is not None:
+            q = q.where(block.c.id > after)
+        return q
+
+    ids = []
+    async for row in db.stream(make_stmt, chunk_size=2):
+        ids.append(row[0])
+        assert (await db.execute(select([block.c.id]).where(
+            block.c.id == row[0]))).scalar() == row[0]
+    assert ids == list(range(1, 8))
+    assert [x[0] async for x in db.stream(make_stmt, 2, 3, chunk_size=2)] == [
+        3, 4, 5]
+    assert [x[0] async for x in db.stream(make_stmt, 1, 4, chunk_size=2)] == [
+        2, 3, 4, 5]
+    db.close()
+
+@pytest.mark.asyncio
+async def test_problem_grades(app_state):
+    app, state = app_state
+    client = app.test_client()
+    state.engine.execute(area.insert(), [{'id': 1, 'name': 'Magic Wood'}])
+    state.engine.execute(sector.insert(), [{'id': 1, 'area': 1},
+                                           {'id': 2, 'area': 1},
+                                           {'id': 3, 'area': 1}])
+
+    r = await post_json(client, '/bulk/add', {
+        'blocks': [
+            {'ref': 'a', 'sector': 1, 'lat': 46.0, 'lon': 7.0},
+            {'ref': 'b', 'sector': 2, 'lat': 46.0, 'lon': 7.0},
+        ],
+        'problems': [
+            {'block_ref': 'a', 'name': 'one', 'grade': '6a+'},
+            {'block_ref': 'a', 'name': 'two', 'grade': 'V6'},
+            {'block_ref': 'b', 'name': 'three', 'grade': '7A'},
+            {'block_ref': 'b', 'name': 'four', 'grade': 'hard'},
+        ]})
+    a, b = r['blocks']
+    await post(client, '/problem/add', form=dict(block=a, name='five',
+                                                 grade='V3'))
+
+    async def names(q):
+        r = await get(client, '/problem/list?q=' + q)
+        return [x['name'] for x in r['problems']]
+
+    assert await names('block:%d' % a) == ['one', 'two', 'five']
+    assert await names('sector:2') == ['three', 'four']
+    assert await names('area:1 grade:7A') == ['two', 'three']
+    assert await names('grade:6A..6B') == ['one', 'five']
+    assert await names('grade:V4..') == ['two', 'three']
+    assert await names('sector:1 grade:..V3') == ['five']
+    assert await names('sector:1 grade:..6A%2B') == ['one', 'five']
+    assert await names('name:~f') == ['four', 'five']
+    r = await get(client, '/problem/list?q=sector:1&limit=2')
+    assert [x['grade'] for x in r['problems']] == ['6a+', 'V6']
+    assert r['next'] == r['problems'][1]['id']
+    r = await get(client, '/block/list?q=grade:V5..V6')
+    assert [x['id'] for x in r['blocks']] == [a, b]
+    for q in ['grade:hard', 'grade:..', 'sector:x', 'bbox:45,6,47,8']:
+        resp = await client.get('/problem/list?q=' + q)
+        assert resp.status_code != 200
+
+    r = await get(client, '/sector/1/grades')
+    assert (r['grades'], r['unranked']) == ([
+        {'rank': 55, 'grade': '6A/6A+', 'count': 1},
+        {'rank': 60, 'grade': '6A+', 'count': 1},
+        {'rank': 110, 'grade': '7A', 'count': 1}], 0)
+    r = await get(client, '/area/1/grades')
+    assert (r['grades'], r['unranked']) == ([
+        {'rank': 55, 'grade': '6A/6A+', 'count': 1},
+        {'rank': 60, 'grade': '6A+', 'count': 1},
+        {'rank': 110, 'grade': '7A', 'count': 2}], 1)
+    r = await get(client, '/sector/3/grades')
+    assert (r['grades'], r['unranked']) == ([], 0)
+    for url in ['/sector/4/grades', '/area/2/grades']:
+        resp = await client.get(url)
+        assert resp.status_code == 505
+
+@pytest.mark.asyncio
+async def test_conditional_get(db):
+    client = db.test_client()
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    resp = await client.get('/block/%d' % block_id)
+    etag = resp.headers['ETag']
+    resp = await client.get('/block/%d' % block_id,
+                            headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    r = await post(client, '/problem/add', form=dict(
+        block=block_id, name="foo bar"))
+    problem_id = r['id']
+    resp = await client.get('/block/%d' % block_id,
+                            headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+    r = await get(client, '/block/%d' % block_id)
+    assert r['problems'] == [problem_id]
+    r = await get(client, '/block/%d?details=1' % block_id)
+    assert r['problems'] == [{'id': problem_id, 'name': 'foo bar',
+                              'grade': None}]
+
+    await post(client, '/block/%d' % block_id, form={'name': 'foo2'})
+    r = await get(client, '/block/%d' % block_id)
+    assert r['name'] == 'foo2'
+    await post_json(client, '/bulk/add', {'problems': [
+        {'block': block_id}]})
+    r = await get(client, '/block/%d?details=1' % block_id)
+    assert len(r['problems']) == 2
+    await post(client, '/block/delete', form={'id': block_id})
+    resp = await client.get('/block/%d' % block_id)
+    assert resp.status_code != 200
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('app_state', [{
+    'DATABASE': 'sqlite:///{tmpdir}/afro.db', 'CACHE': False}], indirect=True)
+async def test_cache_off(app_state, tmpdir):
+    # two apps on one database file, like two worker processes
+    app, state = app_state
+    other = Quart("afro")
+    other.config.update(app.config)
+    register_routes(other, State())
+    client, other_client = app.test_client(), other.test_client()
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    resp = await other_client.get('/block/%d' % block_id)
+    assert 'ETag' not in resp.headers
+    await post(client, '/block/%d' % block_id, form={'name': 'foo2'})
+    r = await get(other_client, '/block/%d' % block_id)
+    assert r['name'] == 'foo2'
+
+    args = parse_args(['8000', 'afro.db', '--workers', '2'])
+    assert make_config(args)['CACHE'] is False
+    args = parse_args(['8000', 'afro.db', '--workers', '1'])
+    assert 'CACHE' not in make_config(args)
+
+@pytest.mark.asyncio
+async def test_search(db):
+    client = db.test_client()
+
+    r = await post_json(client, '/bulk/add', {
+        'blocks': [
+            {'ref': 'a', 'sector': 0, 'lat': 46.0, 'lon': 7.0,
+             'name': 'Big Arête', 'description': 'tall'},
+            {'ref': 'b', 'sector': 0, 'lat': 46.0, 'lon': 7.0,
+             'name': 'Roof'},
+        ],
+        'problems': [
+            {'block_ref': 'b', 'name': 'arete traverse'},
+        ]})
+    a, b = r['blocks']
+    p, = r['problems']
+
+    r = await get(client, '/search?q=aret')
+    assert sorted((x['type'], x['id']) for x in r['results']) == [
+        ('block', a), ('problem', p)]
+    r = await get(client, '/search?q=big aret')
+    assert r['results'] == [{'type': 'block', 'id': a, 'name': 'Big Arête',
+                             'description': 'tall'}]
+    r = await get(client, '/search?q="ro')
+    assert [(x['type'], x['id']) for x in r['results']] == [('block', b)]
+    r = await get(client, '/search?q=aret&limit=1')
+    assert len(r['results']) == 1
+    for limit in ['0', '-1', 'x']:
+        resp = await client.get('/search?q=aret&limit=' + limit)
+        assert resp.status_code != 200
+
+    await post(client, '/block/%d' % b, form={'name': 'Arete roof'})
+    await post(client, '/block/delete', form={'id': a})
+    r = await get(client, '/search?q=arete')
+    assert sorted((x['type'], x['id']) for x in r['results']) == [
+        ('block', b), ('problem', p)]
+    r = await get(client, '/search?q=big')
+    assert r['results'] == []
+    r = await get(client, '/search?q=%2B')
+    assert r['results'] == []
+
+@pytest.mark.asyncio
+async def test_batch(db, tmpdir):
+    @db.route('/broken')
+    async def broken():
+        raise RuntimeError("broken")
+
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    r = await post(client, '/problem/add', form=dict(
+        block=block_id, name="foo bar"))
+    problem_id = r['id']
+    await post(client, '/photo/add', data=b"foobarbaz")
+    await post(client, '/photo/associate', form={
+        'photo_filename': 'photo0.jpg', 'type': 'block', 'id': block_id})
+
+    paths = ['/block/%d?details=1' % block_id, '/block/%d/photos' % block_id,
+             '/photo/photo0.jpg', '/problem/%d/photos' % problem_id,
+             '/problem/1234', '/block/list?q=sector:0&stream=1']
+    r = await post_json(client, '/batch', {'requests': paths})
+    r = r['responses']
+    assert len(r) == len(paths)
+    for resp, path in zip(r[:4], paths):
+        assert resp['status_code'] == 200
+        assert resp['body'] == await get(client, path)
+    assert r[4]['status_code'] != 200
+    assert r[5] == {'status_code': 200, 'body': None}
+
+    r = await post_json(client, '/batch', {'requests': [
+        '/broken', '/block/%d' % block_id, '/nowhere']})
+    assert [x['status_code'] for x in r['responses']] == [500, 200, 404]
+
+    for data in [{'requests': ['/batch']}, {'requests': ['block/1']},
+                 {'requests': '/block/1'},
+                 {'requests': ['/block/1', '/photo/raw/photo0.jpg']},
+                 {'requests': ['/area/1/export']}]:
+        with pytest.raises(Error):
+            await post_json(client, '/batch', data)
+
+@pytest.mark.asyncio
+async def test_sync(db, tmpdir):
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await get(client, '/sync')
+    assert r['rev'] == 0 and r['changed'] == {} and not r['more']
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    r = await post(client, '/problem/add', form=dict(
+        block=block_id, name="foo bar", grade='6A'))
+    problem_id = r['id']
+    r = await get(client, '/sync?since=0')
+    assert r['changed'] == {
+        'block': [{'id': block_id, 'sector': 0, 'name': 'foo',
+                   'description': None, 'lat': 32.15, 'lon': 15.36}],
+        'problem': [{'id': problem_id, 'block': block_id, 'name': 'foo bar',
+                     'description': None, 'grade': '6A'}]}
+    assert r['deleted'] == {}
+    rev = r['rev']
+
+    r = await get(client, '/sync?since=%d' % rev)
+    assert r['rev'] == rev and r['changed'] == {}
+
+    await post(client, '/photo/add', data=b"foobarbaz")
+    await post(client, '/photo/associate', form={
+        'photo_filename': 'photo0.jpg', 'type': 'problem', 'id': problem_id})
+    r = await post(client, '/line/add', form={'problem': problem_id,
+        'photo_filename': 'photo0.jpg', 'point_list': '0.5,0.25'})
+    line_id = r['id']
+    await post(client, '/block/%d' % block_id, form={'name': 'foo2'})
+    r = await get(client, '/sync?since=%d' % rev)
+    assert r['changed']['problem_photos'] == [
+        {'id': problem_id, 'photos': ['photo0.jpg']}]
+    assert r['changed']['line'] == [{'id': line_id, 'photo': 'photo0.jpg',
+        'problem': problem_id, 'points': [[0.5, 0.25]]}]
+    assert r['changed']['block'][0]['name'] == 'foo2'
+    assert 'problem' not in r['changed']
+    rev = r['rev']
+
+    await post(client, '/block/delete', form={'id': block_id})
+    r = await get(client, '/sync?since=%d' % rev)
+    assert r['changed']['block'] == []
+    assert r['deleted']['block'] == [block_id]
+
+    r = await get(client, '/sync?since=%d' % (r['rev'] - 1))
+    assert not r['more']
+    r = await client.get('/sync?since=%d' % (r['rev'] + 1))
+    assert r.status_code == 505
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('app_state', [{
+    'DATABASE': 'sqlite:///{tmpdir}/afro.db',
+    'DATABASE_PRAGMAS': {'busy_timeout': 100}}], indirect=True)
+async def test_sync_while_writing(app_state, tmpdir):
+    app, state = app_state
+    client = app.test_client()
+    await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    # another worker in the middle of a write
+    con = sqlite3.connect(str(tmpdir.join('afro.db')), isolation_level=None)
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        r = await get(client, '/sync')
+        assert len(r['changed']['block']) == 1
+    finally:
+        con.execute('ROLLBACK')
+        con.close()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('use_numpy', [True, False])
+async def test_json_body(db, tmpdir, monkeypatch, use_numpy):
+    from afro import geometry
+    if not use_numpy:
+        monkeypatch.setattr(geometry, 'numpy', None)
+    elif geometry.numpy is None:
+        pytest.skip("numpy not installed")
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await post_json(client, '/block/add', {'sector': 0, 'name': 'foo',
+                                               'lat': 32.15, 'lon': 15.36})
+    block_id = r['id']
+    r = await post_json(client, '/problem/add', {'block': block_id})
+    problem_id = r['id']
+    await post(client, '/photo/add', data=b"foobarbaz")
+    for points in [[0.1, 0.2, 0.3, 0.4], [[0.1, 0.2], [0.3, 0.4]],
+                   "0.1,0.2,0.3,0.4"]:
+        r = await post_json(client, '/line/add', {'problem': problem_id,
+            'photo_filename': 'photo0.jpg', 'point_list': points})
+        r = await get(client, '/line/%d' % r['id'])
+        assert r['points'] == [[0.1, 0.2], [0.3, 0.4]]
+
+    for data, error in [
+            ({'problem': problem_id, 'point_list': [0.1, 0.2]},
+             'parameter photo_filename not passed'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [0.1, 'x']}, 'Not a float: x'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [0.1, None]}, 'Not a float: None'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [True, False, 0.5, 0.5]}, 'Not a float: True'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [[0.5, 0.5], [0.5, False]]}, 'Not a float: False'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [0.1, 1.5]}, '1.5 not in range (0, 1)'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [[0.1, 0.2], [0.3]]}, 'points must be [x, y] pairs'),
+            ({'problem': problem_id, 'photo_filename': 'photo0.jpg',
+              'point_list': [0.1, 0.2], 'foo': 1}, 'Extra parameters passed'),
+            ([1, 2], 'JSON body must be an object')]:
+        with pytest.raises(Error) as e:
+            await post_json(client, '/line/add', data)
+        assert error in e.value.args[0]
+    with pytest.raises(Error) as e:
+        await post_json(client, '/block/add', {'sector': 0, 'lat': 1,
+                                               'lon': 2, 'foo': 'bar'})
+    assert 'unexpected parameter foo passed' in e.value.args[0]
+
+    # same as form data, numbers can be strings, nothing else is converted
+    r = await post_json(client, '/block/add', {'sector': '0', 'lat': 1,
+                                               'lon': '2.5', 'name': 'x'})
+    r = await get(client, '/block/%d' % r['id'])
+    assert (r['sector'], r['lat'], r['lon']) == (0, 1.0, 2.5)
+    for data, error in [
+            ({'sector': 1.9}, 'parameter sector, value 1.9, expected type int'),
+            ({'sector': True}, 'parameter sector, value True'),
+            ({'lat': True}, 'parameter lat, value True, expected type float'),
+            ({'lat': None}, 'parameter lat, value None'),
+            ({'name': {'a': 1}}, "optional parameter name, value {'a': 1}, "
+                                 "expected type str"),
+            ({'name': 5}, 'optional parameter name, value 5')]:
+        with pytest.raises(Error) as e:
+            await post_json(client, '/block/add', dict(
+                {'sector': 0, 'lat': 1.5, 'lon': 2.5}, **data))
+        assert error in e.value.args[0]
+
+@pytest.mark.asyncio
+async def test_metrics_disabled(db):
+    client = db.test_client()
+    resp = await client.get('/metrics')
+    assert resp.status_code == 404
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('app_state', [{
+    'METRICS': True, 'SLOW_REQUEST_TIME': 0}], indirect=True)
+async def test_metrics(app_state, caplog):
+    app, state = app_state
+    client = app.test_client()
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    await get(client, '/block/%d' % r['id'])
+    await get(client, '/block/%d' % r['id'])
+    resp = await client.get('/block/1234')
+    assert resp.status_code == 505
+    assert 'slow request GET /block/<int:block_id>' in caplog.text
+    assert 'SELECT block.sector' in caplog.text
+
+    resp = await client.get('/metrics')
+    assert resp.status_code == 200
+    lines = (await resp.get_data()).decode('utf8').splitlines()
+    series = dict(l.rsplit(' ', 1) for l in lines if not l.startswith('#'))
+    labels = 'route="/block/<int:block_id>",method="GET"'
+    assert series['afro_request_duration_seconds_count{%s}' % labels] == '3'
+    assert series['afro_request_duration_seconds_bucket{%s,le="+Inf"}' %
+                  labels] == '3'
+    assert series['afro_responses_total{%s,status="200"}' % labels] == '2'
+    assert series['afro_responses_total{%s,status="505"}' % labels] == '1'
+    # the second GET is served from the cache
+    assert series['afro_sql_statements_total{%s}' % labels] == '3'
+    assert int(series['afro_sql_statements_total{%s}' %
+        'route="/block/add",method="POST"']) > 0
+
+@pytest.mark.asyncio
+async def test_sqlite_file_settings(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('afro.db'))
+    # two databases behave like two worker processes
+    db1 = Database(url, pragmas={'cache_size': -1024})
+    db2 = Database(url)
+    meta.create_all(db1.engine)
+    assert (await db1.execute('PRAGMA journal_mode')).scalar() == 'wal'
+    assert (await db1.execute('PRAGMA cache_size')).scalar() == -1024
+    assert (await db2.execute('PRAGMA busy_timeout')).scalar() == 5000
+
+    def add_block(con, fail=False):
+        # read, then write
+        (block_id,) = allocate_ids(con, block, 1)
+        con.execute(block.insert().values(id=block_id, name='foo'))
+        if fail:
+            raise ValueError
+        return block_id
+
+    ids = await asyncio.gather(*[db.transaction(add_block)
+                                 for _ in range(20) for db in (db1, db2)])
+    assert sorted(ids) == list(range(1, 41))
+    with pytest.raises(ValueError):
+        await db1.transaction(add_block, True)
+    assert len(await db2.execute(block.select())) == 40
+    db1.close()
+    db2.close()
+
+@pytest.mark.asyncio
+async def test_prepared_statements(app_state):
+    app, state = app_state
+    client = app.test_client()
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    await post(client, '/problem/add', form=dict(block=block_id, name='a'))
+    await get(client, '/block/%d?details=1' % block_id)
+    await get(client, '/photo/many?f=')
+    compiled = len(state.db.compiled_cache)
+    assert compiled > 0
+    for i in range(3):
+        await post(client, '/problem/add', form=dict(block=block_id,
+                                                     name='b%d' % i))
+        await get(client, '/block/%d?details=1&v=%d' % (block_id, i))
+        await get(client, '/photo/many?f=')
+    assert len(state.db.compiled_cache) == compiled
+
+@pytest.mark.asyncio
+async def test_compression(db, tmpdir):
+    import gzip
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'name': 'foo', 'lat': '32.15', 'lon': '15.36'})
+    block_id = r['id']
+    r = await post(client, '/problem/add', form=dict(block=block_id))
+    await post(client, '/photo/add', data=b"foobarbaz")
+    for i in range(20):
+        await post_json(client, '/line/add', {'problem': r['id'],
+            'photo_filename': 'photo0.jpg', 'point_list': [0.123456] * 20})
+    plain = await get(client, '/photo/photo0.jpg')
+
+    headers = {'Accept-Encoding': 'gzip;q=0.8, identity;q=0.1'}
+    resp = await client.get('/photo/photo0.jpg', headers=headers)
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    data = await resp.get_data()
+    assert json.loads(gzip.decompress(data)) == plain
+    etag = resp.headers['ETag']
+    assert etag.startswith('W/')
+    resp = await client.get('/photo/photo0.jpg', headers=dict(
+        headers, **{'If-None-Match': etag}))
+    assert resp.status_code == 304
+    # served from the compressed cache
+    resp = await client.get('/photo/photo0.jpg', headers=headers)
+    assert await resp.get_data() == data
+
+    # below the size threshold or not accepted
+    resp = await client.get('/block/%d' % block_id, headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+    resp = await client.get('/photo/photo0.jpg', headers={
+        'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in resp.headers
+    assert json.loads(await resp.get_data()) == plain
+
+def test_json_provider(db, monkeypatch):
+    from afro import encoding
+    obj = {'b': [0.1, 0.123456, 1.0, 2], 'a': 'Arête', 'c': None,
+           'd': (1, 2), 'e': 2 ** 70}
+    r = db.json.dumps(obj)
+    assert json.loads(r) == json.loads(json.dumps(obj))
+    assert db.json.loads(r) == json.loads(json.dumps(obj))
+    monkeypatch.setattr(encoding, 'orjson', None)
+    assert json.loads(db.json.dumps(obj)) == json.loads(r)
+
+@pytest.mark.asyncio
+async def test_line_simplification(db, tmpdir):
+    client = db.test_client()
+    db.config['tmpdir'] = tmpdir
+
+    r = await post(client, '/block/add', form={'sector': '0',
+        'lat': '32.15', 'lon': '15.36'})
+    r = await post(client, '/problem/add', form=dict(block=r['id']))
+    await post(client, '/photo/add', data=b"foobarbaz")
+    # a wobbly vertical line with one big kink
+    points = [[0.5, 0.1], [0.5005, 0.2], [0.4998, 0.3], [0.6, 0.5],
+              [0.5002, 0.7], [0.5, 0.9]]
+    r = await post_json(client, '/line/add', {'problem': r['id'],
+        'photo_filename': 'photo0.jpg', 'point_list': points})
+    line_id = r['id']
+
+    r = await get(client, '/line/%d' % line_id)
+    assert r['points'] == points
+    for query in ['tolerance=0', 'lod=0']:
+        r = await get(client, '/line/%d?%s' % (line_id, query))
+        assert r['points'] == points
+    r = await get(client, '/line/%d?tolerance=0.05' % line_id)
+    assert r['points'] == [points[0], points[3], points[5]]
+    r = await get(client, '/line/%d?lod=3' % line_id)
+    assert r == await get(client, '/line/%d?tolerance=0.01' % line_id)
+    assert 3 < len(r['points']) < len(points)
+    r = await get(client, '/line/%d?tolerance=0.5' % line_id)
+    assert r['points'] == [points[0], points[5]]
+    r = await get(client, '/photo/photo0.jpg?tolerance=0.05')
+    assert r['lines'][0]['points'] == [points[0], points[3], points[5]]
+    r = await get(client, '/photo/photo0.jpg')
+    assert r['lines'][0]['points'] == points
+    r = await get(client, '/photo/many?f=photo0.jpg&tolerance=1')
+    assert r['photos'][0]['lines'][0]['points'] == [points[0], points[5]]
+
+    for query in ['lod=7', 'tolerance=-1', 'tolerance=x', 'lod=1&tolerance=1']:
+        resp = await client.get('/line/%d?%s' % (line_id, query))
+        assert resp.status_code == 505
+        resp = await client.get('/photo/photo0.jpg?%s' % query)
+        assert resp.status_code == 505
+
+@pytest.mark.asyncio
+async def test_area_tree(app_state, tmpdir):
+    app, state = app_state
+    app.config['tmpdir'] = tmpdir
+    client = app.test_client()
+    state.engine.execute(area.insert(), [{'id': 1, 'name': 'Magic Wood'},
+                                         {'id': 2, 'name': 'empty'}])
+    state.engine.execute(sector.insert(), [
+        {'id': 1, 'area': 1, 'name': 'lower'},
+        {'id': 2, 'area': 1, 'name': 'upper'}])
+
+    r = await post_json(client, '/bulk/add', {
+        'blocks': [
+            {'ref': 'a', 'sector': 1, 'lat': 46.0, 'lon': 7.0, 'name': 'A'},
+            {'ref': 'b', 'sector': 1, 'lat': 46.0, 'lon': 7.0, 'name': 'B'},
+            {'ref': 'c', 'sector': 2, 'lat': 46.0, 'lon': 7.0, 'name': 'C'},
+            {'sector': 0, 'lat': 46.0, 'lon': 7.0, 'name': 'elsewhere'},
+        ],
+        'problems': [
+            {'block_ref': 'a', 'grade': '7A'},
+            {'block_ref': 'a', 'grade': 'f7a'},
+            {'block_ref': 'b', 'grade': '6B'},
+            {'block_ref': 'c', 'grade': 'hard'},
+        ]})
+    a, b, c, _ = r['blocks']
+    p1, p2, p3, p4 = r['problems']
+    await post(client, '/photo/add', data=b"foobarbaz")
+    await post(client, '/photo/associate', form={
+        'photo_filename': 'photo0.jpg', 'type': 'block', 'id': a})
+
+    r = await get(client, '/area/1/tree')
+    assert (r['name'], r['problem_count'], r['photo_count'], r['grades']) == (
+        'Magic Wood', 4, 1, {'7A': 2, '6B': 1})
+    lower, upper = r['sectors']
+    assert (lower['name'], lower['problem_count'], lower['grades']) == (
+        'lower', 3, {'7A': 2, '6B': 1})
+    assert [x['id'] for x in lower['blocks']] == [a, b]
+    block_a = lower['blocks'][0]
+    assert (block_a['problem_count'], block_a['photo_count'],
+            block_a['grades']) == (2, 1, {'7A': 2})
+    assert block_a['problems'] == [{'id': p1, 'name': None, 'grade': '7A'},
+                                   {'id': p2, 'name': None, 'grade': 'f7a'}]
+    assert (upper['problem_count'], upper['grades']) == (1, {})
+    r = await get(client, '/area/1/grades')
+    assert {x['grade']: x['count'] for x in r['grades']} == {'7A': 2, '6B': 1}
+
+    # kept up to date by the writes
+    await post(client, '/problem/add', form=dict(block=c, grade='8A'))
+    await post(client, '/problem/add', form=dict(block=c, grade='V3'))
+    await post(client, '/block/delete', form={'id': b})
+    r = await get(client, '/area/1/tree?problems=0')
+    assert (r['problem_count'], r['grades']) == (5, {'7A': 2, '8A': 1,
+                                                     '6A/6A+': 1})
+    lower, upper = r['sectors']
+    assert [x['id'] for x in lower['blocks']] == [a]
+    assert 'problems' not in lower['blocks'][0]
+    assert (upper['problem_count'], upper['grades']) == (
+        3, {'8A': 1, '6A/6A+': 1})
+
+    r = await get(client, '/area/2/tree')
+    assert (r['sectors'], r['problem_count']) == ([], 0)
+    resp = await client.get('/area/3/tree')
+    assert resp.status_code == 505
@@ -0,0 +1,131 @@
+import io
+
+import pytest
+from quart import Quart
+from sqlalchemy import create_engine, select
+
+from afro.api import register_routes, State
+from afro.archive import (import_archive, export_area, read_records,
+                          ArchiveError)
+from afro.db import get_db, Database
+from afro.geometry import pack_points
+from afro.model import (meta, area, sector, block, problem, photo,
+                        photo_block, line, block_cluster)
+
+@pytest.fixture
+def app():
+    app = Quart("afro")
+    app.config['DATABASE'] = 'sqlite:///:memory:'
+    state = State()
+    get_db(app, state)
+    meta.create_all(state.engine)
+    register_routes(app, state)
+    engine = state.engine
+    engine.execute(area.insert(), [{'id': 1, 'name': 'Magic Wood'},
+                                   {'id': 2, 'name': 'other'}])
+    engine.execute(sector.insert(), [{'id': 1, 'area': 1, 'name': 's1'},
+                                     {'id': 2, 'area': 2, 'name': 's2'}])
+    engine.execute(block.insert(), [
+        {'id': 1, 'sector': 1, 'name': 'Bügeleisen', 'lat': 46.5,
+         'lon': 9.3},
+        {'id': 2, 'sector': 2, 'name': 'elsewhere', 'lat': 1.0, 'lon': 2.0}])
+    engine.execute(problem.insert(), [
+        {'id': 1, 'block': 1, 'name': 'Unendliche Geschichte', 'grade': '8A'},
+        {'id': 2, 'block': 2, 'name': 'x', 'grade': '6A'}])
+    engine.execute(photo.insert(), [{'filename': 'photo0.jpg'},
+                                    {'filename': 'photo1.jpg'}])
+    engine.execute(photo_block.insert(), [{'photo': 'photo0.jpg',
+                                           'block': 1}])
+    engine.execute(line.insert(), [
+        {'id': 1, 'photo': 'photo0.jpg', 'problem': 1,
+         'points': pack_points([(0.1, 0.2), (0.3, 0.4)])}])
+    return app
+
+@pytest.mark.asyncio
+async def test_export_import(app, tmpdir):
+    client = app.test_client()
+    r = await client.get('/area/1/export')
+    assert r.status_code == 200
+    data = await r.get_data()
+
+    kinds = [kind for kind, row in read_records(io.BytesIO(data))]
+    assert kinds == [b'A', b'S', b'B', b'P', b'F', b'b', b'L']
+
+    engine = create_engine('sqlite:///' + str(tmpdir.join('seed.db')))
+    meta.create_all(engine)
+    engine.execute(area.insert().values(name='existing'))
+    with engine.begin() as con:
+        counts = import_archive(con, io.BytesIO(data))
+        assert counts == {'area': 1, 'sector': 1, 'block': 1, 'problem': 1,
+                          'photo': 1, 'photo_block': 1, 'line': 1}
+        # importing again reuses the photos, everything else is added again
+        import_archive(con, io.BytesIO(data))
+    with engine.connect() as con:
+        assert list(con.execute(select([area.c.id, area.c.name]))) == [
+            (1, 'existing'), (2, 'Magic Wood'), (3, 'Magic Wood')]
+        assert list(con.execute(select([sector.c.id, sector.c.area]))) == [
+            (1, 2), (2, 3)]
+        assert list(con.execute(select([block.c.sector, block.c.name,
+                                        block.c.lat]))) == [
+            (1, 'Bügeleisen', 46.5), (2, 'Bügeleisen', 46.5)]
+        assert list(con.execute(select([problem.c.block, problem.c.grade,
+                problem.c.grade_rank, problem.c.description]))) == [
+            (1, '8A', 170, None), (2, '8A', 170, None)]
+        assert list(con.execute(select([line.c.problem, line.c.photo]))) == [
+            (1, 'photo0.jpg'), (2, 'photo0.jpg')]
+        # simplification levels are computed on import
+        assert con.execute(select([line.c.importance]).where(
+            line.c.id == 2)).scalar() is not None
+        assert list(con.execute(select([block_cluster.c.count]).where(
+            block_cluster.c.zoom == 0))) == [(2,)]
+
+    r = await client.get('/area/7/export')
+    assert r.status_code != 200
+    with pytest.raises(ArchiveError):
+        list(read_records(io.BytesIO(data[:-20])))
+
+def test_export_consistent(tmpdir):
+    db = Database('sqlite:///' + str(tmpdir.join('afro.db')))
+    meta.create_all(db.engine)
+    db.engine.execute(area.insert(), [{'id': 1, 'name': 'Magic Wood'}])
+    db.engine.execute(sector.insert(), [{'id': 1, 'area': 1}])
+    db.engine.execute(block.insert(), [{'id': 1, 'sector': 1}])
+    with db.engine.connect() as con:
+        it = export_area(con, 1, chunk_size=1)
+        chunks = [next(it)]
+        # written by another worker while the export is going on
+        db.engine.execute(block.insert(), [{'id': 2, 'sector': 1}])
+        db.engine.execute(problem.insert(), [{'id': 1, 'block': 2}])
+        chunks.extend(it)
+    data = b''.join(chunks)
+    kinds = [kind for kind, row in read_records(io.BytesIO(data))]
+    assert kinds == [b'A', b'S', b'B']
+    db.close()
+
+@pytest.mark.asyncio
+async def test_export_releases_connection(tmpdir):
+    app = Quart("afro")
+    app.config.update(DATABASE='sqlite:///' + str(tmpdir.join('afro.db')),
+                      DATABASE_POOL_SIZE=1, DATABASE_MAX_OVERFLOW=0,
+                      DATABASE_POOL_TIMEOUT=0.1)
+    state = State()
+    get_db(app, state)
+    meta.create_all(state.engine)
+    register_routes(app, state)
+    state.engine.execute(area.insert(), [{'id': 1, 'name': 'Magic Wood'}])
+    client = app.test_client()
+
+    # the test client reads the whole body, dispatch directly to read it
+    # like a slow client
+    async with app.test_request_context('/area/1/export') as ctx:
+        r = await app.full_dispatch_request(ctx)
+    async with r.response as body:
+        body = body.__aiter__()
+        data = await body.__anext__()
+        # the download is still going on, the only connection is free
+        assert (await client.get('/area/1/export')).status_code == 200
+        async for chunk in body:
+            data += chunk
+    kinds = [kind for kind, row in read_records(io.BytesIO(data))]
+    assert kinds == [b'A']
+    state.db.close()
@@ -0,0 +1,52 @@
+from afro.cache import ResponseCache
+
+def test_response_cache():
+    now = [0]
+    cache = ResponseCache(size=2, ttl=10, clock=lambda: now[0])
+    a, b, c = ('block', 1), ('block', 2), ('block', 3)
+    cache.put(a, 'x', 0, 'a-x')
+    cache.put(a, 'y', 0, 'a-y')
+    assert cache.get(a, 'x') == 'a-x'
+    # a-y is the least recently used now
+    cache.put(b, 'x', 0, 'b-x')
+    assert cache.get(a, 'y') is None
+    assert cache.get(a, 'x') == 'a-x'
+
+    etag = cache.etag(a)
+    cache.invalidate(a)
+    assert cache.get(a, 'x') is None
+    assert cache.etag(a) != etag
+    # computed before the invalidation, must not be stored
+    cache.put(a, 'x', 0, 'stale')
+    assert cache.get(a, 'x') is None
+    cache.put(a, 'x', 1, 'a-x')
+    assert cache.get(a, 'x') == 'a-x'
+
+    now[0] = 11
+    assert cache.get(a, 'x') is None
+    assert cache.get(b, 'x') is None
+    cache.put(c, 'x', 0, 'c-x')
+    assert cache.entries.keys() == {(c, 'x')}
+    assert cache.variants == {c: {'x'}}
+
+def test_version_eviction():
+    cache = ResponseCache(size=2)
+    a, b, c = ('block', 1), ('block', 2), ('block', 3)
+    etags = {}
+    for key in (a, a, b):
+        cache.invalidate(key)
+        etags[key] = cache.etag(key)
+    assert cache.version(a) == 2
+    cache.put(a, 'x', 2, 'a-x')
+    # c pushes out b, not a, which was used more recently
+    cache.invalidate(c)
+    assert set(cache.versions) == {a, c}
+    assert cache.floor == 2
+    assert cache.etag(a) == etags[a]
+    # b's old etag must not match again, nor any it had before
+    assert cache.version(b) > 1
+    for key in [('block', i) for i in range(4, 100)]:
+        cache.invalidate(key)
+    assert len(cache.versions) == 2
+    assert cache.version(a) > 2 and cache.version(b) > 1
+    assert cache.version(('block', 1000)) == cache.floor
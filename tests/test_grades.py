@@ -0,0 +1,26 @@
+import pytest
+
+from afro.grades import grade_rank, rank_label, parse_rank, FONT_RANKS
+
+def test_grade_rank():
+    assert grade_rank('6A') == grade_rank('6a') == grade_rank(' f6A ')
+    assert grade_rank('Fb 7A+') == FONT_RANKS['7A+']
+    assert (grade_rank('4') < grade_rank('5+') < grade_rank('6A') <
+            grade_rank('6A+') < grade_rank('7C+') < grade_rank('9A'))
+    # V-scale sits on the same scale, in between Font grades where it spans
+    # two of them
+    assert grade_rank('V6') == grade_rank('7A')
+    assert grade_rank('6A') < grade_rank('V3') < grade_rank('6A+')
+    assert grade_rank('V3-') < grade_rank('V3') < grade_rank('V3+')
+    assert grade_rank('V3/4') == grade_rank('V3/V4')
+    assert grade_rank('V3') < grade_rank('V3/4') < grade_rank('V4')
+    assert grade_rank('6A/6A+') == grade_rank('V3')
+    for grade in [None, '', '6D', '10A', 'V18', 'VX', 'hard', '6A/hard']:
+        assert grade_rank(grade) is None
+
+def test_rank_label():
+    assert [rank_label(grade_rank(x)) for x in ['6A+', 'V6', 'V3', 'VB']] == [
+        '6A+', '7A', '6A/6A+', '3']
+    assert parse_rank('7a') == FONT_RANKS['7A']
+    with pytest.raises(ValueError):
+        parse_rank('hard')
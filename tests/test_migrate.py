@@ -0,0 +1,72 @@
+import math
+
+from sqlalchemy import create_engine, inspect, select, text
+
+from afro.geometry import unpack_points, unpack_floats
+from afro.model import (line, problem, block_rtree, block_cluster,
+                        block_stats, block_grade)
+from migrate import migrate
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE photo (filename VARCHAR NOT NULL, PRIMARY KEY (filename))",
+    "CREATE TABLE line (id INTEGER NOT NULL, photo VARCHAR, problem INTEGER, "
+    "PRIMARY KEY (id))",
+    "CREATE TABLE block (id INTEGER NOT NULL, sector INTEGER, name VARCHAR, "
+    "description VARCHAR, lat FLOAT, lon FLOAT, PRIMARY KEY (id))",
+    "CREATE TABLE point (id INTEGER NOT NULL, line_id INTEGER, x FLOAT, "
+    "y FLOAT, \"index\" INTEGER, PRIMARY KEY (id))",
+    "CREATE TABLE problem (id INTEGER NOT NULL, block INTEGER, name VARCHAR, "
+    "description VARCHAR, grade VARCHAR, PRIMARY KEY (id))",
+]
+
+def test_migrate_points(tmpdir):
+    engine = create_engine('sqlite:///' + str(tmpdir.join('old.db')))
+    with engine.begin() as con:
+        for stmt in LEGACY_SCHEMA:
+            con.execute(text(stmt))
+        con.execute(text("INSERT INTO line (id, photo, problem) VALUES "
+                         "(1, 'photo0.jpg', 1), (2, 'photo0.jpg', 1)"))
+        con.execute(text("INSERT INTO point (line_id, x, y, \"index\") VALUES "
+                         "(1, 0.3, 0.4, 1), (1, 0.1, 0.2, 0), (2, 0.5, 0.5, 0)"))
+        con.execute(text("INSERT INTO block (id, sector, lat, lon) VALUES "
+                         "(1, 0, 46.5, 7.5), (2, 0, NULL, NULL)"))
+        con.execute(text("UPDATE block SET name = 'arete' WHERE id = 2"))
+        con.execute(text("INSERT INTO problem (id, block, grade) VALUES "
+                         "(1, 1, '7a'), (2, 1, 'V3'), (3, 1, NULL), "
+                         "(4, 1, 'f7A')"))
+    migrate(engine)
+    with engine.connect() as con:
+        assert 'point' not in inspect(con).get_table_names()
+        assert [x['name'] for x in inspect(con).get_indexes('block')] == [
+            'ix_block_sector']
+        assert sorted(x['name'] for x in inspect(con).get_indexes(
+            'problem')) == ['ix_problem_block_grade_rank',
+                            'ix_problem_grade_rank']
+        assert list(con.execute(select([problem.c.grade_rank]).order_by(
+            problem.c.id))) == [(110,), (55,), (None,), (110,)]
+        r = {id: unpack_points(points) for id, points in
+             con.execute(select([line.c.id, line.c.points]))}
+        importance = {id: list(unpack_floats(x)) for id, x in
+                      con.execute(select([line.c.id, line.c.importance]))}
+        assert [x[0] for x in con.execute(select([block_rtree.c.id]))] == [1]
+        assert list(con.execute(block_stats.select())) == [(1, 4, 0),
+                                                           (2, 0, 0)]
+        assert list(con.execute(block_grade.select())) == [(1, 55, 1),
+                                                           (1, 110, 2)]
+        assert list(con.execute(select([block_cluster.c.count,
+                block_cluster.c.graded, block_cluster.c.sum_rank]).where(
+            block_cluster.c.zoom == 0))) == [(1, 3, 275)]
+        assert list(con.execute(text("SELECT rowid FROM search_index "
+            "WHERE search_index MATCH 'arete'"))) == [(2 * 4 + 2,)]
+    assert r == {1: [(0.1, 0.2), (0.3, 0.4)], 2: [(0.5, 0.5)]}
+    assert importance == {1: [math.inf, math.inf], 2: [math.inf]}
+    # running it again is a no-op
+    migrate(engine)
+    with engine.connect() as con:
+        assert list(con.execute(block_grade.select())) == [(1, 55, 1),
+                                                           (1, 110, 2)]
+        # the triggers keep it up to date from here on
+        con.execute(problem.insert().values(id=5, block=1, grade='V3',
+                                            grade_rank=55))
+        assert list(con.execute(block_grade.select())) == [(1, 55, 2),
+                                                           (1, 110, 2)]